@@ -707,6 +707,3635 @@ os.listdir('./data')
 
 # Isn't that wonderful? Once all the functions are defined, we can calculate EMIs for thousands or even millions of loans across many files with just a few lines of code, in a few seconds. Now we're starting to see the real power of using a programming language like Python for processing data!
 
+# ## Working with large files
+# 
+# The functions we've defined so far work great for small files, but `read_csv` reads the entire file into memory using `readlines`, and then builds a list containing a dictionary for every loan. If a file contains tens of millions of loans, we'll soon run out of RAM. In this section, we'll look at some techniques for processing large files efficiently.
+# 
+# ### Reading a file lazily using generators
+# 
+# A file object can be used directly in a `for` loop, which reads the file one line at a time. We can combine this with the `yield` statement to create a *generator* function, which produces the loans one by one, only when they are requested.
+# 
+# > **Generators**: A function containing a `yield` statement returns a generator when it is called. The body of the function is executed step by step each time the next value is requested (e.g. by a `for` loop), and the function is paused at the `yield` statement in between. Learn more here: https://docs.python.org/3/howto/functional.html#generators
+
+# In[ ]:
+
+
+def iter_csv(path):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header from the first line
+        headers = parse_headers(f.readline())
+        # Read the remaining lines one at a time
+        for data_line in f:
+            # Parse the values & create a dictionary
+            values = parse_values(data_line)
+            yield create_item_dict(values, headers)
+
+
+# Calling `iter_csv` doesn't read the file yet. We can use the `next` function to request loans one at a time.
+
+# In[ ]:
+
+
+loans2_iter = iter_csv('./data/loans2.txt')
+loans2_iter
+
+
+# In[ ]:
+
+
+next(loans2_iter)
+
+
+# In[ ]:
+
+
+next(loans2_iter)
+
+
+# `read_csv` can now simply collect all the loans produced by `iter_csv` into a list.
+
+# In[ ]:
+
+
+def read_csv(path):
+    return list(iter_csv(path))
+
+
+# Similarly, we can define a generator `iter_emis` which computes the EMI for each loan as it passes through, instead of looping over a list.
+
+# In[ ]:
+
+
+def iter_emis(loans):
+    for loan in loans:
+        loan['emi'] = loan_emi(
+            loan['amount'], 
+            loan['duration'], 
+            loan['rate']/12, # the CSV contains yearly rates
+            loan['down_payment'])
+        yield loan
+
+
+# Finally, `write_csv` uses `len(items)` and `items[0]` which don't work with generators. We can use `next` to get the first item (for the headers) and `itertools.chain` to put it back in front of the remaining items.
+
+# In[ ]:
+
+
+import itertools
+
+def write_csv(items, path):
+    # Open the file in write mode
+    with open(path, 'w') as f:
+        # Get the first item, and return if there's nothing to write
+        items = iter(items)
+        first_item = next(items, None)
+        if first_item is None:
+            return
+        
+        # Write the headers in the first line
+        headers = list(first_item.keys())
+        f.write(','.join(headers) + '\n')
+        
+        # Write one item per line
+        for item in itertools.chain([first_item], items):
+            values = []
+            for header in headers:
+                values.append(str(item.get(header, "")))
+            f.write(','.join(values) + "\n")
+
+
+# The new `write_csv` still works with lists, but we can now also connect the three steps together. Each loan is read, processed and written before the next line of the file is read, so only one loan is held in memory at a time, irrespective of the size of the file.
+
+# In[ ]:
+
+
+for i in range(1,4):
+    loans = iter_csv('./data/loans{}.txt'.format(i))
+    write_csv(iter_emis(loans), './data/emis{}.txt'.format(i))
+
+
+# In[ ]:
+
+
+with open('./data/emis3.txt', 'r') as f:
+    print(f.read())
+
+
+# ### Storing loans column by column using Numpy arrays
+# 
+# Even when we read a file lazily, a list of dictionaries is an expensive way to store a large number of loans: each dictionary (and each float inside it) is a separate Python object, and takes up well over 200 bytes of memory, even though each loan only contains 4 numbers (32 bytes).
+# 
+# A more compact representation is to store each column of the file in a [Numpy](https://numpy.org) array of 64-bit floating point numbers. We'll learn a lot more about Numpy in the next tutorial. For now, it's enough to know that a Numpy array stores numbers of the same type next to each other in memory, with no per-item overhead.
+# 
+# Let's start by defining a helper function `parse_rows` which parses data lines into one long `array` of floats (a compact list of numbers from the built-in `array` module), making sure that each line produces exactly one value per column.
+
+# In[ ]:
+
+
+import array
+import numpy as np
+
+def parse_rows(lines, num_columns):
+    result = array.array('d')
+    for data_line in lines:
+        values = parse_values(data_line)[:num_columns]
+        # Fill in any missing values with 0.0
+        values.extend([0.0] * (num_columns - len(values)))
+        result.extend(values)
+    return result
+
+
+# Next, let's define a class `LoanTable` which holds one array per column. To make it easy to use in place of a list of dictionaries, indexing with a column name returns an entire column, while indexing with a number (or iterating over the table) returns the loans as dictionaries. While iterating, the columns are converted to regular Python numbers a chunk at a time using the `tolist` method, which is much faster than converting each value separately.
+
+# In[ ]:
+
+
+class LoanTable:
+    """A table of loans stored as one Numpy array per column."""
+    chunk_size = 100000 # number of rows converted at a time while iterating
+    
+    def __init__(self, columns):
+        self.columns = dict(columns)
+    
+    @property
+    def headers(self):
+        return list(self.columns.keys())
+    
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+    
+    def __getitem__(self, key):
+        # Get a column using its header
+        if isinstance(key, str):
+            return self.columns[key]
+        # Get a row as a dictionary
+        result = {}
+        for header, column in self.columns.items():
+            result[header] = column[key].item()
+        return result
+    
+    def __setitem__(self, header, column):
+        self.columns[header] = np.asarray(column)
+    
+    def __iter__(self):
+        # Convert a chunk of each column to Python numbers at a time
+        headers = self.headers
+        for start in range(0, len(self), self.chunk_size):
+            columns = []
+            for header in headers:
+                columns.append(self.columns[header][start:start+self.chunk_size].tolist())
+            for values in zip(*columns):
+                yield dict(zip(headers, values))
+    
+    def __repr__(self):
+        return 'LoanTable(headers={}, rows={})'.format(self.headers, len(self))
+
+
+# We can now define `read_csv_columnar`, which parses the file into one flat array and then splits it into a separate contiguous array for each column.
+
+# In[ ]:
+
+
+def read_csv_columnar(path):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header
+        headers = parse_headers(f.readline())
+        # Parse the remaining lines into a flat array of floats
+        values = parse_rows(f, len(headers))
+    # View the values as a 2D array with one row per loan
+    data = np.frombuffer(values, dtype=np.float64).reshape(-1, len(headers))
+    # Copy each column into a separate contiguous array
+    columns = {}
+    for i, header in enumerate(headers):
+        columns[header] = np.ascontiguousarray(data[:, i])
+    return LoanTable(columns)
+
+
+# In[ ]:
+
+
+loans3_table = read_csv_columnar('./data/loans3.txt')
+loans3_table
+
+
+# In[ ]:
+
+
+loans3_table['amount']
+
+
+# In[ ]:
+
+
+loans3_table[2]
+
+
+# The `compute_emis` and `write_csv` functions can now work with entire columns when they receive a `LoanTable`. EMIs are stored as integers, so that they're written to the file exactly as before. For writing, we convert a chunk of rows at a time to regular Python numbers using the `tolist` method.
+
+# In[ ]:
+
+
+def compute_emis(loans):
+    # Compute a whole column of EMIs for tables
+    if isinstance(loans, LoanTable):
+        emis = []
+        for amount, duration, rate, down_payment in zip(loans['amount'].tolist(), 
+                                                        loans['duration'].tolist(), 
+                                                        loans['rate'].tolist(), 
+                                                        loans['down_payment'].tolist()):
+            emis.append(loan_emi(amount, duration, rate/12, down_payment))
+        loans['emi'] = np.array(emis, dtype=np.int64)
+        return
+    
+    for loan in loans:
+        loan['emi'] = loan_emi(
+            loan['amount'], 
+            loan['duration'], 
+            loan['rate']/12, # the CSV contains yearly rates
+            loan['down_payment'])
+
+def write_csv_columnar(table, path, chunk_size=100000):
+    # Open the file in write mode
+    with open(path, 'w') as f:
+        # Return if there's nothing to write
+        if len(table) == 0:
+            return
+        
+        # Write the headers in the first line
+        headers = table.headers
+        f.write(','.join(headers) + '\n')
+        
+        # Write the rows in chunks, one item per line
+        for start in range(0, len(table), chunk_size):
+            columns = []
+            for header in headers:
+                columns.append(table[header][start:start+chunk_size].tolist())
+            for values in zip(*columns):
+                f.write(','.join(map(str, values)) + '\n')
+
+def write_csv(items, path):
+    # Write tables column by column
+    if isinstance(items, LoanTable):
+        write_csv_columnar(items, path)
+        return
+    
+    # Open the file in write mode
+    with open(path, 'w') as f:
+        # Get the first item, and return if there's nothing to write
+        items = iter(items)
+        first_item = next(items, None)
+        if first_item is None:
+            return
+        
+        # Write the headers in the first line
+        headers = list(first_item.keys())
+        f.write(','.join(headers) + '\n')
+        
+        # Write one item per line
+        for item in itertools.chain([first_item], items):
+            values = []
+            for header in headers:
+                values.append(str(item.get(header, "")))
+            f.write(','.join(values) + "\n")
+
+
+# In[ ]:
+
+
+compute_emis(loans3_table)
+write_csv(loans3_table, './data/emis3.txt')
+
+
+# In[ ]:
+
+
+with open('./data/emis3.txt', 'r') as f:
+    print(f.read())
+
+
+# ### Computing EMIs for entire columns at once
+# 
+# `compute_emis` still calls `loan_emi` once for every loan, and the Python interpreter has to execute each arithmetic operation separately, one loan at a time. Numpy arrays support arithmetic operations on entire arrays at once (these are performed by optimized code written in C), so we can compute the EMIs for all the loans with just a few operations.
+# 
+# There are two parts of `loan_emi` that need to be handled differently for arrays:
+# 
+# * Dividing an array by zero doesn't raise a `ZeroDivisionError`, so instead of `try`-`except` we use `np.where` to pick the result `loan_amount / duration` for loans with a 0% rate of interest.
+# * Instead of `math.ceil`, we use `np.ceil` to round up the EMIs of all the loans together.
+
+# In[ ]:
+
+
+def loan_emi_array(amount, duration, rate, down_payment=0):
+    """Calculates the equal montly installments (EMIs) for arrays of loans.
+    
+    Arguments:
+        amount - Array of total amounts to be spent (loan + down payment)
+        duration - Array of durations of the loans (in months)
+        rate - Array of rates of interest (monthly)
+        down_payment (optional) - Array of optional intial payments (deducted from amount)
+    
+    Returns an array of integers, identical to calling `loan_emi` for each loan.
+    """
+    loan_amount = np.asarray(amount, dtype=np.float64) - down_payment
+    duration = np.asarray(duration, dtype=np.float64)
+    rate = np.asarray(rate, dtype=np.float64)
+    if np.any(duration == 0):
+        raise ZeroDivisionError('float division by zero')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = (1+rate)**duration
+        emi = loan_amount * rate * growth / (growth-1)
+        # Loans with a 0% rate of interest
+        emi = np.where(growth == 1, loan_amount / duration, emi)
+    emi = np.ceil(emi)
+    # Raise an error (like `math.ceil`) instead of silently returning invalid integers
+    if np.any(np.isnan(emi)):
+        raise ValueError('cannot convert float NaN to integer')
+    if np.any(np.abs(emi) >= 2.0**63):
+        raise OverflowError('cannot convert EMIs larger than 2**63 to integers')
+    return emi.astype(np.int64)
+
+
+# Let's verify that we get the same EMIs as `loan_emi`, including a loan with a 0% rate of interest.
+
+# In[ ]:
+
+
+loan_emi_array([100000, 100000, 45230], [120, 120, 48], [0.09/12, 0, 0.07/12], [0, 0, 4300])
+
+
+# In[ ]:
+
+
+[loan_emi(100000, 120, 0.09/12), loan_emi(100000, 120, 0), loan_emi(45230, 48, 0.07/12, 4300)]
+
+
+# We can now use `loan_emi_array` in `compute_emis` to process a `LoanTable` without any loops.
+
+# In[ ]:
+
+
+def compute_emis(loans):
+    # Compute a whole column of EMIs for tables
+    if isinstance(loans, LoanTable):
+        loans['emi'] = loan_emi_array(
+            loans['amount'], 
+            loans['duration'], 
+            loans['rate']/12, # the CSV contains yearly rates
+            loans['down_payment'])
+        return
+    
+    for loan in loans:
+        loan['emi'] = loan_emi(
+            loan['amount'], 
+            loan['duration'], 
+            loan['rate']/12, # the CSV contains yearly rates
+            loan['down_payment'])
+
+
+# In[ ]:
+
+
+for i in range(1,4):
+    loans = read_csv_columnar('./data/loans{}.txt'.format(i))
+    compute_emis(loans)
+    write_csv(loans, './data/emis{}.txt'.format(i))
+
+
+# ### Processing many files in parallel
+# 
+# Our loop processes one file at a time, so it only uses one CPU core, even though most computers have several. The `concurrent.futures` module provides a `ProcessPoolExecutor`, which runs a function in several *worker processes* at the same time. Each file can be processed independently, so we can hand the files out to the workers.
+# 
+# Every argument and return value of the function has to be sent between processes, so it's important to return only a small summary for each file (number of rows, time taken, any error), rather than the loans themselves.
+# 
+# > **Note**: Worker processes need to be able to find the function. Only workers started using the `'fork'` method get a copy of the functions defined in a Jupyter notebook, so the helper `process_pool` asks for this method explicitly whenever it's available (it isn't the default on every platform, e.g. Python 3.14 uses `'forkserver'` on Linux). On Windows, which doesn't support `'fork'`, you'll need to move `process_loans_file` (and the functions it uses) into a `.py` file and import it.
+
+# In[ ]:
+
+
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def process_pool(max_workers=None):
+    # Start the workers using 'fork', so that they can use functions defined in the notebook
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, 
+                                   mp_context=multiprocessing.get_context('fork'))
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+def process_loans_file(input_path, output_path):
+    """Reads loans from `input_path`, computes their EMIs and writes them to `output_path`.
+    
+    Returns a small dictionary with the number of rows processed, the time taken and
+    the error message (if the file could not be processed).
+    """
+    result = {'input': input_path, 'output': output_path, 'rows': 0, 'error': None}
+    start_time = time.perf_counter()
+    try:
+        loans = read_csv_columnar(input_path)
+        compute_emis(loans)
+        write_csv(loans, output_path)
+        result['rows'] = len(loans)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+def process_loans_files(paths, max_workers=None):
+    """Processes a list of `(input_path, output_path)` pairs using a pool of worker processes.
+    
+    Arguments:
+        paths - List of (input_path, output_path) pairs
+        max_workers (optional) - Number of worker processes (defaults to the number of CPUs)
+    """
+    input_paths = [input_path for input_path, output_path in paths]
+    output_paths = [output_path for input_path, output_path in paths]
+    with process_pool(max_workers) as executor:
+        return list(executor.map(process_loans_file, input_paths, output_paths))
+
+
+# In[ ]:
+
+
+paths = []
+for i in range(1,4):
+    paths.append(('./data/loans{}.txt'.format(i), './data/emis{}.txt'.format(i)))
+
+process_loans_files(paths, max_workers=3)
+
+
+# A missing or invalid file doesn't stop the other files from being processed. Its error is reported in the results instead.
+
+# In[ ]:
+
+
+process_loans_files([('./data/loans4.txt', './data/emis4.txt')])
+
+
+# ### Parsing a single large file in parallel
+# 
+# Processing files in parallel doesn't help if we have one really large file. However, since every line of a CSV file is parsed independently, we can also split a single file into several *chunks* and parse each chunk in a different worker process.
+# 
+# A chunk can't start or end in the middle of a line, so we pick positions in the file which are `chunk_bytes` apart (64 MB by default), and move each position forward to the start of the next line using `readline`. The file is opened in binary mode (`'rb'`), which allows us to `seek` to any byte position in the file. Using chunks of a fixed size (rather than one chunk per worker) limits the amount of memory used by each worker, even for a file which is many GBs in size.
+
+# In[ ]:
+
+
+def split_file(path, chunk_bytes=64*1024*1024):
+    """Splits the data lines of a CSV file into byte ranges of about `chunk_bytes` bytes,
+    aligned to line boundaries.
+    
+    Returns the headers of the file and a list of `(start, end)` byte positions.
+    """
+    file_size = os.path.getsize(path)
+    # Open the file in binary mode
+    with open(path, 'rb') as f:
+        # Parse the header
+        headers = parse_headers(f.readline().decode())
+        boundaries = [f.tell()]
+        while file_size - boundaries[-1] > chunk_bytes:
+            # Move the position to the start of the following line
+            f.seek(boundaries[-1] + chunk_bytes - 1)
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            boundaries.append(f.tell())
+        boundaries.append(file_size)
+    return headers, list(zip(boundaries[:-1], boundaries[1:]))
+
+def iter_chunk_lines(path, start, end):
+    # Read the lines between the byte positions `start` and `end` one at a time
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode()
+
+def parse_chunk(path, start, end, num_columns):
+    """Parses the data lines between the byte positions `start` and `end` of a CSV file.
+    
+    Returns a 2D array with one row per loan.
+    """
+    values = parse_rows(iter_chunk_lines(path, start, end), num_columns)
+    return np.frombuffer(values, dtype=np.float64).reshape(-1, num_columns)
+
+
+# In[ ]:
+
+
+split_file('./data/loans3.txt', chunk_bytes=100)
+
+
+# `read_csv_parallel` parses the chunks using a pool of worker processes. `executor.map` returns the results in the same order as the chunks, so we can join them back together using `np.concatenate`, one column at a time.
+
+# In[ ]:
+
+
+def read_csv_parallel(path, max_workers=None, chunk_bytes=64*1024*1024):
+    """Reads a CSV file into a `LoanTable`, parsing chunks of the file in parallel.
+    
+    Arguments:
+        path - Path of the CSV file
+        max_workers (optional) - Number of worker processes (defaults to the number of CPUs)
+        chunk_bytes (optional) - Approximate size of each chunk (in bytes)
+    """
+    headers, chunk_ranges = split_file(path, chunk_bytes)
+    starts = [start for start, end in chunk_ranges]
+    ends = [end for start, end in chunk_ranges]
+    with process_pool(max_workers) as executor:
+        chunks = list(executor.map(parse_chunk, 
+                                   itertools.repeat(path), 
+                                   starts, 
+                                   ends, 
+                                   itertools.repeat(len(headers))))
+    # Join the chunks together, one column at a time
+    columns = {}
+    for i, header in enumerate(headers):
+        columns[header] = np.concatenate([chunk[:, i] for chunk in chunks])
+    return LoanTable(columns)
+
+
+# In[ ]:
+
+
+loans3_table = read_csv_parallel('./data/loans3.txt', max_workers=3, chunk_bytes=100)
+loans3_table['amount']
+
+
+# ### Caching parsed files
+# 
+# If we read the same file many times (e.g. every time the notebook is restarted), converting its text into floats each time is wasted work. Instead, we can save the parsed columns in Numpy's binary `.npz` format in a *sidecar* file next to the original file (e.g. `loans2.txt.npz`), and load them directly the next time.
+# 
+# We must be careful to not use the cached values if the original file has changed. To detect this, we store the size of the file, the time at which it was last modified (`mtime`) and a *hash* of its contents in the sidecar file. Checking the size and `mtime` is very fast, while the hash (computed using the `hashlib` module) catches changes which leave the size and `mtime` unchanged. The cached values are used only if all three still match, and a damaged sidecar file is simply ignored and replaced.
+
+# In[ ]:
+
+
+import hashlib
+import tempfile
+import zipfile
+
+def file_hash(path, block_size=1024*1024):
+    """Computes the SHA-256 hash of the contents of a file, reading one block at a time."""
+    result = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            result.update(block)
+    return result.hexdigest()
+
+def cache_path(path):
+    return path + '.npz'
+
+def load_cached_table(path):
+    """Loads the `LoanTable` cached for the CSV file `path`, or returns `None` if
+    there's no cache or the file has changed since it was cached."""
+    if not os.path.exists(cache_path(path)):
+        return None
+    stat = os.stat(path)
+    try:
+        with np.load(cache_path(path)) as cached:
+            # Check the size & modification time first, since it's fast
+            if cached['size'] != stat.st_size or cached['mtime_ns'] != stat.st_mtime_ns:
+                return None
+            if str(cached['sha256']) != file_hash(path):
+                return None
+            columns = {}
+            for i, header in enumerate(cached['headers']):
+                columns[str(header)] = cached['column_{}'.format(i)]
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # A damaged cache file is treated just like a missing one
+        return None
+    return LoanTable(columns)
+
+def save_cached_table(table, path, stat, sha256):
+    """Saves a `LoanTable` parsed from the CSV file `path` to its sidecar cache file."""
+    arrays = {}
+    for i, header in enumerate(table.headers):
+        arrays['column_{}'.format(i)] = table[header]
+    # Write to a (uniquely named) temporary file first, so that a partially written cache is never used
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, 
+                 headers=np.array(table.headers), 
+                 size=stat.st_size, 
+                 mtime_ns=stat.st_mtime_ns, 
+                 sha256=sha256, 
+                 **arrays)
+    os.replace(temp_path, cache_path(path))
+
+
+# Let's add an optional argument `cache` to `read_csv_columnar` and `read_csv`. The size, `mtime` and hash are recorded *before* the file is parsed, so that a file modified while it's being read is parsed again the next time.
+
+# In[ ]:
+
+
+def read_csv_columnar(path, cache=False):
+    # Use the cached values, if possible
+    if cache:
+        table = load_cached_table(path)
+        if table is not None:
+            return table
+        stat = os.stat(path)
+        sha256 = file_hash(path)
+    
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header
+        headers = parse_headers(f.readline())
+        # Parse the remaining lines into a flat array of floats
+        values = parse_rows(f, len(headers))
+    # View the values as a 2D array with one row per loan
+    data = np.frombuffer(values, dtype=np.float64).reshape(-1, len(headers))
+    # Copy each column into a separate contiguous array
+    columns = {}
+    for i, header in enumerate(headers):
+        columns[header] = np.ascontiguousarray(data[:, i])
+    table = LoanTable(columns)
+    
+    if cache:
+        save_cached_table(table, path, stat, sha256)
+    return table
+
+def read_csv(path, cache=False):
+    if cache:
+        return list(read_csv_columnar(path, cache=True))
+    return list(iter_csv(path))
+
+
+# In[ ]:
+
+
+read_csv('./data/loans2.txt', cache=True)
+
+
+# In[ ]:
+
+
+os.listdir('./data')
+
+
+# The second time around, the values are loaded from `loans2.txt.npz`, and no parsing is required.
+
+# In[ ]:
+
+
+read_csv('./data/loans2.txt', cache=True)
+
+
+# ### Looking up loans without loading the file using memory maps
+# 
+# Sometimes we only need to look at a few loans in a very large file, e.g. the loan on row 48,000,000. With a CSV file, there's no way to find a particular row without reading every line before it, because each line has a different length.
+# 
+# If we instead store each column as a sequence of fixed-size 8-byte numbers in a binary file, the position of any value can be calculated directly: it's just the row number multiplied by 8. Numpy can *memory-map* such a file using `np.memmap`: the file appears as an array, but its contents are read from the disk by the operating system only when (and where) they are accessed.
+# 
+# We'll create a directory (the *loan store*) containing one file per column, in Numpy's `.npy` file format, which stores a small header describing the shape & type of the array, followed by the raw numbers. Keeping the values of a column next to each other means that scanning a column (or a range of rows of a column) reads only the parts of the disk containing that column, while looking up a single loan reads just one value from each column file. A small file `headers.json` records the order of the columns.
+# 
+# The function `np.lib.format.open_memmap` creates a new `.npy` file and memory-maps it, so we can fill it in a chunk at a time.
+
+# In[ ]:
+
+
+import json
+
+def write_loan_store(loans, path, chunk_size=100000):
+    """Writes loans to a directory containing one binary file per column.
+    
+    Arguments:
+        loans - A `LoanTable`, or a list of dictionaries (as returned by `read_csv`)
+        path - Path of the directory to be created
+        chunk_size (optional) - Number of loans to copy at a time
+    """
+    # Convert a list of dictionaries to columns
+    if not isinstance(loans, LoanTable):
+        headers = list(loans[0].keys()) if len(loans) > 0 else []
+        columns = {}
+        for header in headers:
+            columns[header] = np.array([loan.get(header, 0.0) for loan in loans])
+        loans = LoanTable(columns)
+    
+    os.makedirs(path, exist_ok=True)
+    for i, header in enumerate(loans.headers):
+        column = loans[header]
+        column_file = np.lib.format.open_memmap(os.path.join(path, 'column_{}.npy'.format(i)), 
+                                                mode='w+', dtype=column.dtype, shape=(len(column),))
+        for start in range(0, len(column), chunk_size):
+            column_file[start:start+chunk_size] = column[start:start+chunk_size]
+        column_file.flush()
+    with open(os.path.join(path, 'headers.json'), 'w') as f:
+        json.dump(loans.headers, f)
+
+
+# The class `LoanStore` opens each column file using `np.load` with `mmap_mode='r'`, and offers the same kinds of indexing as `LoanTable`. Indexing with a column name returns the (memory-mapped) column, so that slicing it reads only the requested rows. Indexing with a number reads just one value from each column, and a range of rows is returned as a `LoanTable`.
+
+# In[ ]:
+
+
+class LoanStore:
+    """A read-only directory of column files, accessed lazily using memory maps."""
+    def __init__(self, path, chunk_size=100000):
+        self.path = path
+        self.chunk_size = chunk_size # number of rows read at a time while iterating
+        with open(os.path.join(path, 'headers.json'), 'r') as f:
+            headers = json.load(f)
+        self.columns = {}
+        for i, header in enumerate(headers):
+            self.columns[header] = np.load(os.path.join(path, 'column_{}.npy'.format(i)), mmap_mode='r')
+    
+    @property
+    def headers(self):
+        return list(self.columns.keys())
+    
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+    
+    def __getitem__(self, key):
+        # Get a (lazy) column using its header
+        if isinstance(key, str):
+            return self.columns[key]
+        # Get a range of rows as a LoanTable
+        if isinstance(key, slice):
+            columns = {}
+            for header, column in self.columns.items():
+                columns[header] = np.array(column[key])
+            return LoanTable(columns)
+        # Get a single row as a dictionary
+        result = {}
+        for header, column in self.columns.items():
+            result[header] = column[key].item()
+        return result
+    
+    def __iter__(self):
+        # Read the rows a chunk at a time
+        for start in range(0, len(self), self.chunk_size):
+            yield from self[start:start+self.chunk_size]
+    
+    def __repr__(self):
+        return 'LoanStore(path={!r}, headers={}, rows={})'.format(self.path, self.headers, len(self))
+
+
+# In[ ]:
+
+
+loans3_table = read_csv_columnar('./data/loans3.txt')
+compute_emis(loans3_table)
+write_loan_store(loans3_table, './data/emis3-store')
+
+
+# In[ ]:
+
+
+os.listdir('./data/emis3-store')
+
+
+# In[ ]:
+
+
+emis3_store = LoanStore('./data/emis3-store')
+emis3_store
+
+
+# In[ ]:
+
+
+emis3_store[4]
+
+
+# In[ ]:
+
+
+emis3_store['emi'][2:6]
+
+
+# In[ ]:
+
+
+emis3_store[10:]
+
+
+# ### Downloading many files at once
+# 
+# At the start of this tutorial, we downloaded the files one after another using `urlretrieve`. Most of the time spent downloading a small file is spent waiting for the server to respond, so we can download several files at once using a `ThreadPoolExecutor`, which is similar to `ProcessPoolExecutor` but runs the function in several *threads* within the same process.
+# 
+# We can also avoid downloading files which haven't changed since we last downloaded them, using a few features of the HTTP protocol:
+# 
+# * **Conditional requests**: Servers usually send an `ETag` (a version identifier) and/or a `Last-Modified` date along with a file. If we send these back in the `If-None-Match` and `If-Modified-Since` headers, the server responds with the status `304 Not Modified` (and no data) if the file hasn't changed.
+# * **Range requests**: If a download is interrupted, the `Range` header can be used to request only the remaining part of the file. The `If-Range` header makes sure that we get the entire file again if it has changed in the meantime.
+# 
+# The downloaded files are stored in a *content-addressed* cache: each file is saved under the name of its SHA-256 hash (using the `file_hash` function defined earlier), and an index file `index.json` records the hash and validators (`ETag` & `Last-Modified`) for every URL.
+
+# In[ ]:
+
+
+import json
+import shutil
+import threading
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+cache_index_lock = threading.Lock()
+url_locks = {}
+
+def url_lock(url):
+    # Returns a lock which allows only one thread at a time to download a URL
+    with cache_index_lock:
+        return url_locks.setdefault(url, threading.Lock())
+
+def read_cache_index(cache_dir):
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+def update_cache_index(cache_dir, url, entry):
+    # Only one thread at a time may modify the index
+    with cache_index_lock:
+        index = read_cache_index(cache_dir)
+        index[url] = entry
+        temp_path = os.path.join(cache_dir, 'index.json.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(temp_path, os.path.join(cache_dir, 'index.json'))
+
+
+# The function `download_file` downloads a single URL into the cache (resuming a partial download, if there is one) and copies the cached file to the given path. If the server refuses to resume the download (e.g. with the status `416 Range Not Satisfiable`, when the partial file was in fact already complete), the partial file is discarded and the whole file is downloaded again.
+
+# In[ ]:
+
+
+def download_file(url, path, cache_dir='./data/.cache', block_size=1024*1024, timeout=60):
+    """Downloads `url` to `path` using a local cache, and returns a dictionary describing the result.
+    
+    The `status` of the result is one of 'downloaded', 'resumed', 'not-modified' or 'failed'.
+    """
+    result = {'url': url, 'path': path, 'status': None, 'bytes': 0, 'error': None}
+    os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, 'partial'), exist_ok=True)
+    url_hash = hashlib.sha256(url.encode()).hexdigest()
+    partial_path = os.path.join(cache_dir, 'partial', url_hash)
+    partial_info_path = partial_path + '.json'
+    
+    # Download the same URL in only one thread at a time
+    with url_lock(url):
+        with cache_index_lock:
+            entry = read_cache_index(cache_dir).get(url)
+        
+        # Ask the server to skip the data if our cached copy is up to date
+        headers = {}
+        if entry and os.path.exists(os.path.join(cache_dir, 'objects', entry['sha256'])):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        # Ask for the rest of a partial download, if it's still the same file
+        elif os.path.exists(partial_path) and os.path.exists(partial_info_path):
+            with open(partial_info_path, 'r') as f:
+                partial_info = json.load(f)
+            validator = partial_info.get('etag') or partial_info.get('last_modified')
+            if validator and os.path.getsize(partial_path) > 0:
+                headers['Range'] = 'bytes={}-'.format(os.path.getsize(partial_path))
+                headers['If-Range'] = validator
+        
+        try:
+            response = None
+            try:
+                response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    result['status'] = 'not-modified'
+                elif 'Range' in headers:
+                    # The partial download can't be resumed, so start over
+                    os.remove(partial_path)
+                    os.remove(partial_info_path)
+                    response = urllib.request.urlopen(url, timeout=timeout)
+                else:
+                    raise
+            
+            if response is not None:
+                with response:
+                    # 206 means that the server sent only the remaining part of the file
+                    resumed = response.status == 206
+                    if not resumed:
+                        with open(partial_info_path, 'w') as f:
+                            json.dump({'etag': response.headers.get('ETag'), 
+                                       'last_modified': response.headers.get('Last-Modified')}, f)
+                    with open(partial_path, 'ab' if resumed else 'wb') as f:
+                        for block in iter(lambda: response.read(block_size), b''):
+                            f.write(block)
+                            result['bytes'] += len(block)
+                    # Keep the partial file if the connection was closed early
+                    expected_bytes = response.headers.get('Content-Length')
+                    if expected_bytes is not None and result['bytes'] < int(expected_bytes):
+                        raise IOError('Received {} of {} bytes'.format(result['bytes'], expected_bytes))
+                    entry = {'etag': response.headers.get('ETag'), 
+                             'last_modified': response.headers.get('Last-Modified'), 
+                             'sha256': file_hash(partial_path)}
+                # Move the complete file into the cache, named by its hash
+                os.replace(partial_path, os.path.join(cache_dir, 'objects', entry['sha256']))
+                os.remove(partial_info_path)
+                update_cache_index(cache_dir, url, entry)
+                result['status'] = 'resumed' if resumed else 'downloaded'
+            
+            # Copy the cached file to the requested path, unless it's already there
+            object_path = os.path.join(cache_dir, 'objects', entry['sha256'])
+            if not os.path.exists(path) or file_hash(path) != entry['sha256']:
+                shutil.copyfile(object_path, path)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+def download_files(downloads, cache_dir='./data/.cache', max_workers=8):
+    """Downloads a list of `(url, path)` pairs at the same time, using a pool of threads."""
+    urls = [url for url, path in downloads]
+    paths = [path for url, path in downloads]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(download_file, urls, paths, itertools.repeat(cache_dir)))
+
+
+# In[ ]:
+
+
+url4 = 'https://hub.jovian.ml/wp-content/uploads/2020/08/climate.csv'
+
+download_files([(url1, './data/loans1.txt'), 
+                (url2, './data/loans2.txt'), 
+                (url3, './data/loans3.txt'), 
+                (url4, './data/climate.csv')])
+
+
+# When we run the same cell again, the server responds with `304 Not Modified` for every file, and nothing is downloaded.
+
+# In[ ]:
+
+
+download_files([(url1, './data/loans1.txt'), 
+                (url2, './data/loans2.txt'), 
+                (url3, './data/loans3.txt'), 
+                (url4, './data/climate.csv')])
+
+
+# ### Testing the downloader with a local web server
+# 
+# To check that conditional and resumed downloads really work (without needing an internet connection), we can run a web server on our own computer using the `http.server` module. The built-in `SimpleHTTPRequestHandler` sends neither an `ETag` nor partial responses, so let's extend it to support the `If-None-Match`, `Range` and `If-Range` headers. The class attribute `max_bytes` lets us simulate a connection which breaks in the middle of a download.
+
+# In[ ]:
+
+
+import http.server
+import functools
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files in a directory, with support for ETags and range requests."""
+    max_bytes = None # close the connection after sending this many bytes
+    
+    @staticmethod
+    def etag_of(path):
+        return '"{}"'.format(file_hash(path)[:16])
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        etag = self.etag_of(path)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        # Send only the requested part of the file, if it hasn't changed
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.max_bytes is not None:
+            body = body[:self.max_bytes]
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+# Let's start the server in a background thread, serving the files from the `data` directory.
+
+# In[ ]:
+
+
+server = http.server.ThreadingHTTPServer(
+    ('127.0.0.1', 0), # use any free port
+    functools.partial(RangeRequestHandler, directory='./data'))
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+base_url
+
+
+# First, we'll break the connection after 100 bytes. The download fails, but the partial file is kept in the cache.
+
+# In[ ]:
+
+
+os.makedirs('./downloads', exist_ok=True)
+RangeRequestHandler.max_bytes = 100
+download_file(base_url + 'loans3.txt', './downloads/loans3.txt', cache_dir='./downloads/.cache')
+
+
+# When we try again, only the remaining bytes are requested, and the download is `'resumed'`.
+
+# In[ ]:
+
+
+RangeRequestHandler.max_bytes = None
+download_file(base_url + 'loans3.txt', './downloads/loans3.txt', cache_dir='./downloads/.cache')
+
+
+# Now let's download all the files. The same URL may appear more than once, in which case the second download waits for the first one and then finds the file in the cache. `loans3.txt` hasn't changed, so the server responds with `304 Not Modified`.
+
+# In[ ]:
+
+
+local_downloads = []
+for i in range(1,4):
+    local_downloads.append((base_url + 'loans{}.txt'.format(i), './downloads/loans{}.txt'.format(i)))
+local_downloads.append((base_url + 'loans1.txt', './downloads/loans1-copy.txt'))
+
+download_files(local_downloads, cache_dir='./downloads/.cache')
+
+
+# In[ ]:
+
+
+download_files(local_downloads, cache_dir='./downloads/.cache')
+
+
+# Finally, let's simulate a partial download which was in fact complete (e.g. because the program stopped just before moving it into the cache). The server answers the range request with `416 Range Not Satisfiable`, so the partial file is discarded, and the file is downloaded again.
+
+# In[ ]:
+
+
+url_hash = hashlib.sha256((base_url + 'loans2.txt').encode()).hexdigest()
+partial_path = os.path.join('./downloads/.cache/partial', url_hash)
+shutil.copyfile('./data/loans2.txt', partial_path)
+with open(partial_path + '.json', 'w') as f:
+    json.dump({'etag': RangeRequestHandler.etag_of('./data/loans2.txt')}, f)
+os.remove('./downloads/.cache/index.json')
+
+download_file(base_url + 'loans2.txt', './downloads/loans2.txt', cache_dir='./downloads/.cache')
+
+
+# In[ ]:
+
+
+server.shutdown()
+server.server_close()
+
+
+# ### Measuring performance with benchmarks
+# 
+# How do we know whether a change to one of our functions actually makes it faster, or whether it accidentally makes it slower? Timing a cell with `%%time` once in a while isn't enough. Instead, we can write a *benchmark*: a function which runs each stage of the pipeline (`read_csv_columnar`, `compute_emis` and `write_csv`) on files of different sizes and records:
+# 
+# * the time taken by each stage, as **rows per second** and **MB per second**
+# * the **peak memory** used by the process (called the *resident set size* or RSS), using the `resource` module
+# 
+# The results are saved to a JSON file as a *baseline*. Each later run is compared against the baseline, and fails if any stage has become slower by more than a given factor.
+# 
+# First, we need some loans to work with. Let's define a function which creates a file containing any number of random loans. Random numbers are generated using Numpy, with a fixed *seed*, so that the same file is generated every time.
+
+# In[ ]:
+
+
+def write_random_loans(path, num_rows, seed=42, chunk_size=100000):
+    """Writes a CSV file containing `num_rows` random loans."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        f.write('amount,duration,rate,down_payment\n')
+        for start in range(0, num_rows, chunk_size):
+            size = min(chunk_size, num_rows - start)
+            amounts = rng.integers(10000, 5000000, size).tolist()
+            durations = rng.choice([12, 24, 36, 48, 60, 120, 240, 360], size).tolist()
+            rates = rng.choice([0.06, 0.07, 0.08, 0.1, 0.12, 0.14], size).tolist()
+            down_payments = rng.integers(0, 100000, size).tolist()
+            has_down_payment = (rng.random(size) < 0.5).tolist()
+            for amount, duration, rate, down_payment, has_dp in zip(
+                    amounts, durations, rates, down_payments, has_down_payment):
+                f.write('{},{},{},{}\n'.format(amount, duration, rate, down_payment if has_dp else ''))
+
+
+# The `resource` module (available on Linux and macOS) reports the peak memory of the process. To measure each file size separately, the benchmark for each file runs in a new worker process. Since a small file is processed in just a few milliseconds, each stage is run repeatedly until at least 0.2 seconds have passed, and we record the average time per run.
+
+# In[ ]:
+
+
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is measured in KB on Linux (and in bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+def time_stage(stage, min_seconds=0.2):
+    """Runs the function `stage` repeatedly (like the `timeit` module) until at least
+    `min_seconds` have passed, and returns its result and the average time per run."""
+    num_runs = 0
+    start_time = time.perf_counter()
+    while True:
+        result = stage()
+        num_runs += 1
+        seconds = time.perf_counter() - start_time
+        if seconds >= min_seconds:
+            return result, seconds / num_runs
+
+def benchmark_file(input_path, output_path):
+    """Runs the pipeline on a CSV file, and returns the measurements for each stage."""
+    results = {}
+    
+    def record(stage, seconds, num_rows, num_bytes):
+        results[stage] = {'seconds': seconds, 
+                          'rows_per_sec': num_rows / seconds, 
+                          'mb_per_sec': num_bytes / 1024**2 / seconds, 
+                          'peak_memory_mb': peak_memory_mb()}
+    
+    loans, seconds = time_stage(lambda: read_csv_columnar(input_path))
+    record('parse', seconds, len(loans), os.path.getsize(input_path))
+    
+    _, seconds = time_stage(lambda: compute_emis(loans))
+    record('compute', seconds, len(loans), sum(loans[header].nbytes for header in loans.headers))
+    
+    _, seconds = time_stage(lambda: write_csv(loans, output_path))
+    record('write', seconds, len(loans), os.path.getsize(output_path))
+    return results
+
+
+# `run_benchmarks` creates the input files (if they don't already exist), benchmarks each of them, and compares the rows per second of every stage with the baseline. Timings of short runs vary quite a bit, so each benchmark is run a few times and the fastest run of each stage is kept. The suite is designed for files with 1 thousand, 100 thousand, 10 million and 100 million loans, but the larger sizes take a while (and a lot of disk space), so we'll run just the first two here.
+
+# In[ ]:
+
+
+BENCHMARK_SIZES = [1000, 100000, 10000000, 100000000]
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, data_dir='./data/benchmarks', max_slowdown=1.5, repeat=3, 
+                   update_baseline=False):
+    """Benchmarks the pipeline on files of the given sizes, and compares the results with a baseline.
+    
+    Arguments:
+        sizes (optional) - Number of loans in each benchmark file
+        data_dir (optional) - Directory for the benchmark files & the baseline `baseline.json`
+        max_slowdown (optional) - Fail if a stage is this many times slower than the baseline
+        repeat (optional) - Number of times to run each benchmark (the fastest run of each stage is kept)
+        update_baseline (optional) - Save the results as the new baseline
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    results = {}
+    for size in sizes:
+        input_path = os.path.join(data_dir, 'loans-{}.txt'.format(size))
+        if not os.path.exists(input_path):
+            write_random_loans(input_path, size)
+        output_path = os.path.join(data_dir, 'emis-{}.txt'.format(size))
+        results[str(size)] = {}
+        for i in range(repeat):
+            # Use a new process for each run, so that peak memory is measured separately
+            with process_pool(1) as executor:
+                stages = executor.submit(benchmark_file, input_path, output_path).result()
+            for stage, measurements in stages.items():
+                best = results[str(size)].get(stage)
+                if best is None or measurements['seconds'] < best['seconds']:
+                    results[str(size)][stage] = measurements
+    
+    # Save the first results (or when asked to) as the baseline
+    baseline_path = os.path.join(data_dir, 'baseline.json')
+    if update_baseline or not os.path.exists(baseline_path):
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        return results
+    
+    # Compare the results with the baseline
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    regressions = []
+    for size, stages in results.items():
+        for stage, measurements in stages.items():
+            if size not in baseline or stage not in baseline[size]:
+                continue
+            expected = baseline[size][stage]['rows_per_sec']
+            if measurements['rows_per_sec'] * max_slowdown < expected:
+                regressions.append('{} ({} rows): {:.0f} rows/s, baseline {:.0f} rows/s'.format(
+                    stage, size, measurements['rows_per_sec'], expected))
+    if regressions:
+        raise RuntimeError('Benchmarks are slower than the baseline:\n' + '\n'.join(regressions))
+    return results
+
+
+# In[ ]:
+
+
+run_benchmarks(BENCHMARK_SIZES[:2])
+
+
+# Running the benchmarks again compares the new results with the baseline saved by the first run. If you make a function slower (try adding `time.sleep(1)` to `compute_emis`), you'll see a `RuntimeError` listing the stages which have become slower.
+
+# In[ ]:
+
+
+run_benchmarks(BENCHMARK_SIZES[:2])
+
+
+# ### Generating large test files quickly
+# 
+# `write_random_loans` formats and writes one loan at a time, which takes several minutes for a file with 100 million loans. To generate large files quickly, we need to build the text of the file using Numpy operations on entire arrays, without a Python loop over the loans.
+# 
+# The trick is to represent the text as a 2D array of bytes, with one column per loan and a fixed number of characters (rows) per loan. The digits of a number can be computed column by column using `% 10` and `// 10`, and converted to characters by adding 48 (the code for the character `'0'`). Positions which shouldn't appear in the output (e.g. leading zeros, or a blank down payment) are filled with the byte `0`, and removed at the end using a boolean mask. The result can be written to the file directly using `.tobytes()`.
+
+# In[ ]:
+
+
+def format_digits(values, width):
+    """Formats an array of non-negative integers as ASCII digits, and returns a 2D array
+    with one row per digit position and one column per value.
+    
+    Leading zeros are replaced by the byte 0, which is removed when the text is joined.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    result = np.empty((width, len(values)), dtype=np.uint8)
+    # Numbers with up to 9 digits fit into 32-bit integers, which are faster to divide
+    remaining = values.astype(np.uint32) if width <= 9 else values
+    for i in range(width-1, -1, -1):
+        remaining, digit = np.divmod(remaining, 10)
+        result[i] = digit + ord('0')
+        # Blank out the leading zeros, but keep the last digit of the number 0
+        if i < width-1:
+            result[i][values < 10**(width-1-i)] = 0
+    return result
+
+def format_loans(amounts, durations, rates, down_payments):
+    """Formats loans as the lines of a CSV file, and returns the text as bytes.
+    
+    Arguments:
+        amounts, durations - Arrays of integers
+        rates - Array of integer rates in thousandths (e.g. 125 for 0.125)
+        down_payments - Array of integer down payments, where -1 means blank
+    """
+    num_rows = len(amounts)
+    comma = np.full((1, num_rows), ord(','), dtype=np.uint8)
+    newline = np.full((1, num_rows), ord('\n'), dtype=np.uint8)
+    # Rates are written as "0." followed by up to 3 digits, without trailing zeros
+    rate_digits = format_digits(rates + 1000, 4)
+    rate_digits[0] = ord('.')
+    rate_digits[3][rates % 10 == 0] = 0
+    rate_digits[2][rates % 100 == 0] = 0
+    # Blank down payments are left out
+    down_payment_digits = format_digits(np.maximum(down_payments, 0), 8)
+    down_payment_digits[:, down_payments < 0] = 0
+    
+    text = np.vstack([format_digits(amounts, 8), comma, 
+                      format_digits(durations, 3), comma, 
+                      np.full((1, num_rows), ord('0'), dtype=np.uint8), rate_digits, comma, 
+                      down_payment_digits, newline])
+    # Read the characters loan by loan, skipping the blanked out positions
+    text = text.T.ravel()
+    return text[text != 0].tobytes()
+
+
+# In[ ]:
+
+
+format_loans(np.array([10000, 200000]), np.array([36, 12]), np.array([80, 125]), np.array([20000, -1]))
+
+
+# Next, let's generate realistic random loans: amounts between 10,000 and 5,000,000 (more small loans than large ones), durations between 12 and 360 months, rates between 5% and 15% (with a few 0% loans), and a blank down payment for about half the loans.
+# 
+# To be able to generate a file in parallel, we split the loans into *blocks* of 1 million loans, and generate each block using its own random number generator, seeded with both the `seed` and the number of the block. This way, each block is always the same, irrespective of which process generates it or in which order.
+
+# In[ ]:
+
+
+LOAN_DURATIONS = np.array([12, 16, 24, 27, 36, 48, 60, 90, 99, 120, 180, 240, 300, 360])
+
+def random_loans_block(seed, block_index, block_size=1000000):
+    """Generates a block of random loans, and returns the arrays of amounts, durations,
+    rates (in thousandths) and down payments (-1 for blank)."""
+    rng = np.random.default_rng([seed, block_index])
+    amounts = np.round(np.exp(rng.uniform(np.log(10000), np.log(5000000), block_size)), -1).astype(np.int64)
+    durations = rng.choice(LOAN_DURATIONS, block_size)
+    rates = rng.integers(10, 31, block_size) * 5
+    rates[rng.random(block_size) < 0.01] = 0
+    down_payments = np.round(amounts * rng.uniform(0, 0.3, block_size), -2).astype(np.int64)
+    down_payments[rng.random(block_size) < 0.5] = -1
+    return amounts, durations, rates, down_payments
+
+def write_synthetic_loans(path, num_rows, seed=42, first_row=0, block_size=1000000):
+    """Writes the loans `first_row` to `first_row + num_rows` of a random dataset to a CSV file."""
+    with open(path, 'wb') as f:
+        f.write(b'amount,duration,rate,down_payment\n')
+        row = first_row
+        while row < first_row + num_rows:
+            # Generate the block containing the row, and write the required part of it
+            block_index, offset = divmod(row, block_size)
+            size = min(block_size - offset, first_row + num_rows - row)
+            block = random_loans_block(seed, block_index, block_size)
+            f.write(format_loans(*(column[offset:offset+size] for column in block)))
+            row += size
+
+
+# In[ ]:
+
+
+write_synthetic_loans('./data/synthetic.txt', 10)
+
+with open('./data/synthetic.txt', 'r') as f:
+    print(f.read())
+
+
+# Large datasets can be written as several *shards* (files containing a part of the loans each) in parallel. The shards together contain exactly the same loans as a single file generated with the same seed.
+
+# In[ ]:
+
+
+def write_synthetic_loans_sharded(path_template, num_rows, num_shards, seed=42, max_workers=None):
+    """Writes a random dataset as `num_shards` CSV files in parallel, and returns their paths.
+    
+    Arguments:
+        path_template - Path of the shards, containing `{}` for the number of the shard
+        num_rows - Total number of loans
+        num_shards - Number of files to create
+        seed (optional) - Seed for the random number generators
+        max_workers (optional) - Number of worker processes (defaults to the number of CPUs)
+    """
+    rows_per_shard = math.ceil(num_rows / num_shards)
+    paths, shard_sizes, first_rows = [], [], []
+    for i in range(num_shards):
+        paths.append(path_template.format(i))
+        first_rows.append(i * rows_per_shard)
+        shard_sizes.append(max(0, min(rows_per_shard, num_rows - i * rows_per_shard)))
+    with process_pool(max_workers) as executor:
+        list(executor.map(write_synthetic_loans, paths, shard_sizes, itertools.repeat(seed), first_rows))
+    return paths
+
+
+# In[ ]:
+
+
+start_time = time.perf_counter()
+shard_paths = write_synthetic_loans_sharded('./data/synthetic-{}.txt', 4000000, num_shards=4)
+print('Generated {:.0f} MB in {:.2f} seconds'.format(
+    sum(os.path.getsize(path) for path in shard_paths) / 1024**2, time.perf_counter() - start_time))
+
+
+# Finally, let's use the new generator for the benchmarks by redefining `write_random_loans`.
+
+# In[ ]:
+
+
+def write_random_loans(path, num_rows, seed=42):
+    write_synthetic_loans(path, num_rows, seed)
+
+
+# ### Finding the slow stage with profiling
+# 
+# Benchmarks tell us how fast the pipeline is on test files, but when processing real files it's also useful to know where the time goes: is it `read_csv`, `compute_emis` or `write_csv`? Let's define a class `PipelineProfiler` which measures each *stage* of the pipeline:
+# 
+# * the elapsed (wall clock) time, using `time.perf_counter`
+# * the CPU time used by the process, using `time.process_time` (if it's much lower than the wall time, the stage is waiting for the disk)
+# * the number of rows processed, and the number of bytes read and written
+# * the peak amount of memory allocated by Python during the stage, using the `tracemalloc` module
+# 
+# A stage is measured using a `with` statement, which provides a dictionary where the code inside the block can record the rows and bytes it processed. The measurements can be reported in the JSON format, or in the text format used by the [Prometheus](https://prometheus.io) monitoring system. In the Prometheus format, the measurements which are added up across calls are reported as *counters* (with names ending in `_total`), so that functions like `rate()` can be used on them, while the peak memory is reported as a *gauge*.
+# 
+# Profiling is turned off unless it's requested, either explicitly or by setting the environment variable `LOANS_PROFILE=1`. Tracing memory allocations slows down Python code considerably (several times, for `write_csv`), so it can be switched off separately using `trace_allocations=False`.
+
+# In[ ]:
+
+
+import contextlib
+import tracemalloc
+
+class PipelineProfiler:
+    """Records the time, rows, bytes and memory allocations of each stage of a pipeline."""
+    def __init__(self, enabled=None, trace_allocations=True):
+        # Use the environment variable LOANS_PROFILE if not enabled/disabled explicitly
+        if enabled is None:
+            enabled = os.environ.get('LOANS_PROFILE', '') not in ('', '0')
+        self.enabled = enabled
+        self.trace_allocations = trace_allocations
+        self.stages = {}
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        counts = {'rows': 0, 'bytes_read': 0, 'bytes_written': 0}
+        if not self.enabled:
+            yield counts
+            return
+        
+        started_tracing = self.trace_allocations and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        wall_before, cpu_before = time.perf_counter(), time.process_time()
+        try:
+            yield counts
+        finally:
+            wall_seconds = time.perf_counter() - wall_before
+            cpu_seconds = time.process_time() - cpu_before
+            # get_traced_memory returns zeros if allocations aren't being traced
+            peak_allocated = max(0, tracemalloc.get_traced_memory()[1] - memory_before)
+            if started_tracing:
+                tracemalloc.stop()
+            # Add up the measurements if a stage is run more than once
+            metrics = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 
+                                                    'rows': 0, 'bytes_read': 0, 'bytes_written': 0, 
+                                                    'peak_allocated_bytes': 0})
+            metrics['calls'] += 1
+            metrics['wall_seconds'] += wall_seconds
+            metrics['cpu_seconds'] += cpu_seconds
+            for key, value in counts.items():
+                metrics[key] += value
+            metrics['peak_allocated_bytes'] = max(metrics['peak_allocated_bytes'], peak_allocated)
+    
+    def to_json(self):
+        return json.dumps(self.stages, indent=2)
+    
+    def to_prometheus(self, prefix='loans_pipeline'):
+        lines = []
+        metric_names = []
+        for metrics in self.stages.values():
+            for metric_name in metrics:
+                if metric_name not in metric_names:
+                    metric_names.append(metric_name)
+        for metric_name in metric_names:
+            # The peak memory is a gauge, the other metrics only increase (they're added up) so they're counters
+            if metric_name == 'peak_allocated_bytes':
+                name, metric_type = '{}_{}'.format(prefix, metric_name), 'gauge'
+            else:
+                name, metric_type = '{}_{}_total'.format(prefix, metric_name), 'counter'
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for stage_name, metrics in self.stages.items():
+                lines.append('{}{{stage="{}"}} {}'.format(name, stage_name, metrics[metric_name]))
+        return '\n'.join(lines) + '\n'
+
+
+# The function `run_pipeline` reads a file, computes the EMIs and writes the results, measuring each stage using a profiler. When profiling is disabled, `profiler.stage` does nothing, so there's no need for a separate version of the function without profiling.
+
+# In[ ]:
+
+
+def run_pipeline(input_path, output_path, profiler=None):
+    """Computes the EMIs for the loans in `input_path` and writes them to `output_path`, 
+    recording the measurements for each stage in `profiler`."""
+    if profiler is None:
+        profiler = PipelineProfiler()
+    with profiler.stage('read_csv') as counts:
+        loans = read_csv_columnar(input_path)
+        counts['rows'] = len(loans)
+        counts['bytes_read'] = os.path.getsize(input_path)
+    with profiler.stage('compute_emis') as counts:
+        compute_emis(loans)
+        counts['rows'] = len(loans)
+    with profiler.stage('write_csv') as counts:
+        write_csv(loans, output_path)
+        counts['rows'] = len(loans)
+        counts['bytes_written'] = os.path.getsize(output_path)
+    return profiler
+
+
+# To make the pipeline usable from a terminal, we can also define a function `main` which reads *command line arguments* using the `argparse` module. Profiling can be enabled using the flag `--profile` (or the environment variable `LOANS_PROFILE`), and the report is printed in the format chosen with `--profile-format`. If the function is saved in a file `loans.py` along with a call `main()`, it can be run as `python loans.py loans1.txt emis1.txt --profile`.
+
+# In[ ]:
+
+
+import argparse
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Compute the EMIs for the loans in a CSV file.')
+    parser.add_argument('input_path', help='CSV file containing the loans')
+    parser.add_argument('output_path', help='CSV file to write the loans with their EMIs to')
+    parser.add_argument('--profile', action='store_true', default=None, 
+                        help='measure each stage (also enabled by the environment variable LOANS_PROFILE=1)')
+    parser.add_argument('--profile-format', choices=['json', 'prometheus'], default='json', 
+                        help='format of the profiling report')
+    parser.add_argument('--no-trace-allocations', action='store_true', 
+                        help="don't measure memory allocations while profiling (which is slow)")
+    args = parser.parse_args(args)
+    
+    profiler = PipelineProfiler(args.profile, trace_allocations=not args.no_trace_allocations)
+    run_pipeline(args.input_path, args.output_path, profiler)
+    if profiler.enabled:
+        if args.profile_format == 'prometheus':
+            print(profiler.to_prometheus(), end='')
+        else:
+            print(profiler.to_json())
+
+
+# In[ ]:
+
+
+write_synthetic_loans('./data/synthetic-100k.txt', 100000)
+main(['./data/synthetic-100k.txt', './data/synthetic-emis-100k.txt', '--profile'])
+
+
+# In[ ]:
+
+
+main(['./data/synthetic-100k.txt', './data/synthetic-emis-100k.txt', '--profile', '--profile-format', 'prometheus', 
+      '--no-trace-allocations'])
+
+
+# Without the flag, nothing is measured or printed, unless the environment variable is set.
+
+# In[ ]:
+
+
+main(['./data/synthetic-100k.txt', './data/synthetic-emis-100k.txt'])
+
+
+# In[ ]:
+
+
+os.environ['LOANS_PROFILE'] = '1'
+main(['./data/loans3.txt', './data/emis3.txt'])
+del os.environ['LOANS_PROFILE']
+
+
+# ### Reusing EMIs with a cache
+# 
+# Loans are usually created from a small catalog of products, so the same combination of amount, duration, rate and down payment can appear millions of times in a file. Yet `loan_emi` recomputes `(1+rate)**duration` for every row. Instead, we can *memoize* the function: remember the EMIs that have already been computed, and look them up when the same arguments appear again.
+# 
+# The `functools.lru_cache` decorator does exactly this. To keep the memory usage bounded, it holds at most `maxsize` results, and when it's full, it discards the *least recently used* (LRU) result. The function `cached_loan_emi` creates a cached version of `loan_emi` with the given size, and `emi_cache_stats` reports how many lookups were *hits* (found in the cache) or *misses* (computed).
+
+# In[ ]:
+
+
+import functools
+
+def cached_loan_emi(maxsize=4096):
+    """Returns a version of `loan_emi` which remembers the last `maxsize` EMIs computed.
+    
+    Arguments:
+        maxsize (optional) - Maximum number of EMIs to keep (None for no limit)
+    """
+    return functools.lru_cache(maxsize=maxsize)(loan_emi)
+
+def emi_cache_stats(emi_function):
+    """Returns the hits, misses, size and hit rate of a function created by `cached_loan_emi`."""
+    info = emi_function.cache_info()
+    lookups = info.hits + info.misses
+    return {'hits': info.hits, 
+            'misses': info.misses, 
+            'maxsize': info.maxsize, 
+            'currsize': info.currsize, 
+            'hit_rate': info.hits / lookups if lookups else 0.0}
+
+
+# `compute_emis` can now accept the function used to calculate each EMI. Passing a cached function opts into the cache, and since the function can be reused, its cache (and statistics) carry over from one file to the next. Tables are processed with `loan_emi_array`, which doesn't compute anything row by row, so the cache is only used for lists of loans.
+
+# In[ ]:
+
+
+def compute_emis(loans, emi_function=loan_emi):
+    # Compute a whole column of EMIs for tables
+    if isinstance(loans, LoanTable):
+        loans['emi'] = loan_emi_array(
+            loans['amount'], 
+            loans['duration'], 
+            loans['rate']/12, # the CSV contains yearly rates
+            loans['down_payment'])
+        return
+    
+    for loan in loans:
+        loan['emi'] = emi_function(
+            loan['amount'], 
+            loan['duration'], 
+            loan['rate']/12, # the CSV contains yearly rates
+            loan['down_payment'])
+
+
+# Let's try it out on a large list of loans created from the handful of products in `loans3.txt`.
+
+# In[ ]:
+
+
+loans3 = read_csv('./data/loans3.txt')
+catalog_loans = [dict(loan) for i in range(50000) for loan in loans3]
+len(catalog_loans)
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+compute_emis(catalog_loans)
+time.perf_counter() - start
+
+
+# In[ ]:
+
+
+emi_function = cached_loan_emi(maxsize=1024)
+start = time.perf_counter()
+compute_emis(catalog_loans, emi_function)
+time.perf_counter() - start
+
+
+# In[ ]:
+
+
+emi_cache_stats(emi_function)
+
+
+# Since the cache has a fixed size, a file with more distinct loans than `maxsize` just has a lower hit rate, without using more memory. The cache can be emptied with `emi_function.cache_clear()`.
+
+# ### Looking up annuity factors in a precomputed table
+# 
+# For each loan, `loan_emi` computes the power `(1+rate)**duration` twice, which is much slower than a multiplication. However, the EMI can also be written as the loan amount multiplied by an *annuity factor*, which only depends on the rate and the duration:
+# 
+# ```
+# factor = rate * (1+rate)**duration / ((1+rate)**duration - 1)
+# emi = ceil(loan_amount * factor)
+# ```
+# 
+# Since loans are created from a catalog of products, there are only a few distinct rates and durations. We can compute the factors for every combination of them once, using numpy *broadcasting*: an array of rates with the shape `(num_rates, 1)` combined with an array of durations with the shape `(num_durations,)` gives a 2-dimensional grid of factors with the shape `(num_rates, num_durations)`.
+# 
+# The class `AnnuityTable` holds such a grid, and can be indexed with a rate and a duration, like `table[rate, duration]`. It provides two ways of computing EMIs:
+# 
+# * `emi` calculates the EMI of a single loan (like `loan_emi`), by looking up the factor in a dictionary.
+# * `emis` calculates the EMIs for arrays of loans (like `loan_emi_array`), by finding the position of each rate and duration in the sorted arrays of distinct values with `np.searchsorted`.
+# 
+# Loans whose rate or duration isn't in the table are passed on to `loan_emi` or `loan_emi_array`.
+# 
+# Multiplying by the factor performs the operations of `loan_emi` in a different order, so the result is rounded slightly differently. Usually this makes no difference once the EMI is rounded up, but an EMI which is (extremely close to) a whole number could be rounded up to the next rupee by one method and not by the other. Like `loan_emi_paise`, we treat EMIs within `1e-12` (relative) of a whole number as *ambiguous*, and recompute just those with `loan_emi` or `loan_emi_array`, so the results are always identical.
+
+# In[ ]:
+
+
+class AnnuityTable:
+    """A grid of annuity factors for every combination of the given (monthly) rates and durations."""
+    def __init__(self, rates, durations):
+        self.rates = np.unique(np.asarray(rates, dtype=np.float64))
+        self.durations = np.unique(np.asarray(durations, dtype=np.float64))
+        if np.any(self.durations == 0):
+            raise ZeroDivisionError('float division by zero')
+        rate, duration = self.rates[:, np.newaxis], self.durations[np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth = (1+rate)**duration
+            # Loans with a 0% rate of interest just repay an equal part of the amount every month
+            self.factors = np.where(growth == 1, 1 / duration, rate * growth / (growth-1))
+        # Dictionary for looking up the factors of individual loans
+        self.factors_by_key = {}
+        for i, rate in enumerate(self.rates.tolist()):
+            for j, duration in enumerate(self.durations.tolist()):
+                self.factors_by_key[rate, duration] = self.factors[i, j].item()
+    
+    @property
+    def shape(self):
+        return self.factors.shape
+    
+    def __getitem__(self, key):
+        return self.factors_by_key[key]
+    
+    def lookup(self, rates, durations):
+        """Returns the factors for arrays of rates and durations, and a mask which is
+        False for the loans that aren't in the table (their factors are NaN)."""
+        rates = np.asarray(rates, dtype=np.float64)
+        durations = np.asarray(durations, dtype=np.float64)
+        rate_index = np.minimum(np.searchsorted(self.rates, rates), len(self.rates)-1)
+        duration_index = np.minimum(np.searchsorted(self.durations, durations), len(self.durations)-1)
+        found = (self.rates[rate_index] == rates) & (self.durations[duration_index] == durations)
+        factors = np.where(found, self.factors[rate_index, duration_index], np.nan)
+        return factors, found
+    
+    def emi(self, amount, duration, rate, down_payment=0):
+        """Calculates the EMI for a loan (see `loan_emi`) using the table."""
+        factor = self.factors_by_key.get((rate, duration))
+        if factor is None:
+            return loan_emi(amount, duration, rate, down_payment)
+        emi = (amount - down_payment) * factor
+        # Recompute EMIs which are so close to a whole number that rounding could differ from `loan_emi`
+        if abs(emi - round(emi)) <= 1e-12 * abs(emi):
+            return loan_emi(amount, duration, rate, down_payment)
+        return math.ceil(emi)
+    
+    def emis(self, amount, duration, rate, down_payment=0):
+        """Calculates the EMIs for arrays of loans (see `loan_emi_array`) using the table."""
+        loan_amount = np.asarray(amount, dtype=np.float64) - down_payment
+        factors, found = self.lookup(rate, duration)
+        emi = loan_amount * factors
+        # Compute the EMIs of the loans that aren't in the table, and of those which are so close
+        # to a whole number that rounding could differ from `loan_emi_array`
+        recompute = ~found | (np.abs(emi - np.round(emi)) <= 1e-12 * np.abs(emi))
+        emi = np.ceil(emi)
+        if np.any(recompute):
+            emi[recompute] = loan_emi_array(np.broadcast_to(loan_amount, emi.shape)[recompute], 
+                                            np.broadcast_to(duration, emi.shape)[recompute], 
+                                            np.broadcast_to(rate, emi.shape)[recompute])
+        if np.any(np.isnan(emi)):
+            raise ValueError('cannot convert float NaN to integer')
+        if np.any(np.abs(emi) >= 2.0**63):
+            raise OverflowError('cannot convert EMIs larger than 2**63 to integers')
+        return emi.astype(np.int64)
+    
+    def __repr__(self):
+        return 'AnnuityTable({} rates x {} durations)'.format(*self.shape)
+
+
+# Let's create a table for the rates (from 5% to 15% in steps of 0.5%, and 0%) and durations of our product catalog. The rates need to be computed the same way as in `compute_emis` (the yearly rate divided by 12), so that they match exactly.
+
+# In[ ]:
+
+
+catalog_rates = np.append(np.arange(10, 31) * 5 / 1000, 0) / 12
+annuity_table = AnnuityTable(catalog_rates, LOAN_DURATIONS)
+annuity_table
+
+
+# In[ ]:
+
+
+annuity_table[0.09/12, 120], annuity_table[0, 120]
+
+
+# In[ ]:
+
+
+annuity_table.emi(100000, 120, 0.09/12), annuity_table.emi(100000, 121, 0.09/12), loan_emi(100000, 121, 0.09/12)
+
+
+# `compute_emis` can now use the table for lists of loans, if one is provided (we'll see below why it isn't used for a `LoanTable`).
+
+# In[ ]:
+
+
+def compute_emis(loans, emi_function=loan_emi, annuity_table=None):
+    # Compute a whole column of EMIs for tables
+    if isinstance(loans, LoanTable):
+        loans['emi'] = loan_emi_array(
+            loans['amount'], 
+            loans['duration'], 
+            loans['rate']/12, # the CSV contains yearly rates
+            loans['down_payment'])
+        return
+    
+    if annuity_table is not None:
+        emi_function = annuity_table.emi
+    for loan in loans:
+        loan['emi'] = emi_function(
+            loan['amount'], 
+            loan['duration'], 
+            loan['rate']/12, # the CSV contains yearly rates
+            loan['down_payment'])
+
+
+# Let's compare the time taken with and without the table, for a list of loans and for a `LoanTable`.
+
+# In[ ]:
+
+
+synthetic_loans = read_csv('./data/synthetic-100k.txt')
+start = time.perf_counter()
+compute_emis(synthetic_loans)
+print('loan_emi: {:.3f}s'.format(time.perf_counter() - start))
+emis = [loan['emi'] for loan in synthetic_loans]
+
+start = time.perf_counter()
+compute_emis(synthetic_loans, annuity_table=annuity_table)
+print('AnnuityTable.emi: {:.3f}s'.format(time.perf_counter() - start))
+sum(loan['emi'] != emi for loan, emi in zip(synthetic_loans, emis))
+
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+start = time.perf_counter()
+compute_emis(synthetic_table)
+print('loan_emi_array: {:.3f}s'.format(time.perf_counter() - start))
+emis = synthetic_table['emi']
+
+start = time.perf_counter()
+table_emis = annuity_table.emis(synthetic_table['amount'], synthetic_table['duration'], 
+                                synthetic_table['rate']/12, synthetic_table['down_payment'])
+print('AnnuityTable.emis: {:.3f}s'.format(time.perf_counter() - start))
+np.count_nonzero(table_emis != emis)
+
+
+# A few things to note:
+# 
+# * For a list of loans, the table saves the time spent on computing powers, but looking up the factor (which requires hashing a tuple of two floats) and checking whether the EMI is ambiguous cost about as much, and most of the time goes into reading and writing the dictionary of each loan anyway. For a `LoanTable`, numpy computes the powers for an entire column in a few milliseconds, and searching for the positions of the rates and durations in the table takes longer than that. So, `compute_emis` only offers the table for lists of loans, and even there it's only worth it if the powers are a larger part of the work than in our measurements (e.g. when the loans aren't stored in dictionaries). It's always a good idea to measure an optimization before relying on it!
+# * Thanks to the recomputation of the ambiguous EMIs, the results are identical to those of `loan_emi` and `loan_emi_array`.
+
+# ### Amortization schedules
+# 
+# The EMI tells us how much is paid every month, but not how each payment is split between *interest* (charged on the balance of the loan) and *principal* (which reduces the balance). Let's define a generator `amortization_schedule` which yields the *schedule* of a loan one month at a time: the payment, the interest and principal parts of the payment, and the balance left after the payment.
+# 
+# Since the EMI is rounded up to a whole number, the loan is repaid slightly faster than required, so the last payment is a little smaller than the others: it's just enough to clear the balance. As it's a generator, the months are only computed as they are needed, so we can look at the first few months of a long loan without computing the rest.
+
+# In[ ]:
+
+
+def amortization_schedule(amount, duration, rate, down_payment=0):
+    """Generates the month-by-month repayment schedule of a loan.
+    
+    Arguments:
+        amount - Total amount to be spent (loan + down payment)
+        duration - Duration of the loan (in months)
+        rate - Rate of interest (monthly)
+        down_payment (optional) - Optional intial payment (deducted from amount)
+    
+    Yields a dictionary with the month, payment, principal, interest and balance for each month.
+    """
+    # Durations read from CSV files are floats (e.g. 12.0), but `range` needs an integer
+    duration = int(duration)
+    emi = loan_emi(amount, duration, rate, down_payment)
+    balance = amount - down_payment
+    for month in range(1, duration+1):
+        interest = balance * rate
+        # The last payment clears whatever is left of the loan
+        if month == duration:
+            payment = balance + interest
+        else:
+            payment = min(emi, balance + interest)
+        principal = payment - interest
+        balance -= principal
+        yield {'month': month, 
+               'payment': payment, 
+               'principal': principal, 
+               'interest': interest, 
+               'balance': balance}
+
+
+# In[ ]:
+
+
+for month in amortization_schedule(100000, 12, 0.09/12):
+    print('{month:>2}  {payment:>9.2f}  {principal:>9.2f}  {interest:>7.2f}  {balance:>9.2f}'.format(**month))
+
+
+# In[ ]:
+
+
+loan = read_csv('./data/loans2.txt')[0]
+schedule = amortization_schedule(loan['amount'], loan['duration'], loan['rate']/12, loan['down_payment'])
+loan, list(itertools.islice(schedule, 3))
+
+
+# Looping over every month of every loan in Python would be very slow for millions of loans. Instead, we can compute the balance after any number of months directly, using the formula for the balance of a loan with an interest rate `r` after `k` payments of `emi`:
+# 
+# ```
+# balance = loan_amount * (1+r)**k - emi * ((1+r)**k - 1) / r
+# ```
+# 
+# (For a 0% rate of interest, it's simply `loan_amount - emi * k`). Once the balance drops to zero, it stays zero. The function `remaining_balance` computes this formula for arrays of loans and numbers of months. For very small rates, `(1+r)**k` is so close to 1 that subtracting 1 leaves only a few correct digits, so we compute `(1+r)**k - 1` as `np.expm1(k * np.log1p(r))` instead, which avoids the subtraction.
+
+# In[ ]:
+
+
+def remaining_balance(loan_amount, emi, rate, months):
+    """Returns the balances of loans after paying `months` EMIs.
+    
+    Arguments:
+        loan_amount - Array of loan amounts (excluding the down payments)
+        emi - Array of EMIs
+        rate - Array of rates of interest (monthly)
+        months - Array of numbers of EMIs paid
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # `(1+rate)**months - 1` loses most of its digits for tiny rates, so use `expm1` and `log1p`
+        growth_minus_1 = np.expm1(months * np.log1p(rate))
+        balance = loan_amount * (growth_minus_1+1) - emi * growth_minus_1 / rate
+        # Loans with a 0% rate of interest
+        balance = np.where(rate == 0, loan_amount - emi * months, balance)
+    return np.maximum(balance, 0)
+
+
+# Using `remaining_balance`, the function `amortization_schedules` computes the schedules of many loans at once, and returns a dictionary of arrays. The schedules can be returned in two shapes:
+# 
+# * *padded*: 2-dimensional arrays with one row per loan and one column per month (up to the longest duration). The months after the end of a loan are filled with zeros. This is convenient, but wastes memory when the durations vary a lot.
+# * *ragged*: 1-dimensional arrays which contain the schedules of all the loans one after the other, without any padding. The array `offsets` gives the position where each loan's schedule starts, so the schedule of loan `i` is `schedule['payment'][offsets[i]:offsets[i+1]]`.
+# 
+# For ragged schedules, we use `np.repeat` to repeat the details of each loan once for every month of its duration.
+
+# In[ ]:
+
+
+def amortization_schedules(amount, duration, rate, down_payment=0, ragged=False):
+    """Computes the month-by-month repayment schedules of arrays of loans.
+    
+    Arguments:
+        amount - Array of total amounts to be spent (loan + down payment)
+        duration - Array of durations of the loans (in months)
+        rate - Array of rates of interest (monthly)
+        down_payment (optional) - Array of optional intial payments (deducted from amount)
+        ragged (optional) - Whether to return the schedules one after the other, instead of padded
+    
+    Returns a dictionary of arrays with the month, payment, principal, interest and balance,
+    with the shape (loans, months), or 1-dimensional arrays with the `offsets` of the loans if ragged.
+    """
+    loan_amount = np.asarray(amount, dtype=np.float64) - down_payment
+    loan_amount, duration, rate = np.broadcast_arrays(loan_amount, np.asarray(duration, dtype=np.int64), 
+                                                      np.asarray(rate, dtype=np.float64))
+    emi = loan_emi_array(loan_amount, duration, rate)
+    schedule = {}
+    if ragged:
+        offsets = np.zeros(len(duration)+1, dtype=np.int64)
+        np.cumsum(duration, out=offsets[1:])
+        loan_index = np.repeat(np.arange(len(duration)), duration)
+        month = np.arange(offsets[-1]) - offsets[loan_index] + 1
+        schedule['offsets'] = offsets
+    else:
+        loan_index = np.arange(len(duration))[:, np.newaxis]
+        month = np.arange(1, duration.max(initial=0)+1)[np.newaxis, :]
+    loan_amount, duration, rate, emi = loan_amount[loan_index], duration[loan_index], rate[loan_index], emi[loan_index]
+    
+    # The balance before the payment is 0 in the padding, and after the last payment
+    balance_before = np.where(month <= duration, remaining_balance(loan_amount, emi, rate, month-1), 0)
+    balance = np.where(month < duration, remaining_balance(loan_amount, emi, rate, month), 0)
+    interest = balance_before * rate
+    principal = balance_before - balance
+    schedule['month'] = month if ragged else month[0]
+    schedule['payment'] = principal + interest
+    schedule['principal'] = principal
+    schedule['interest'] = interest
+    schedule['balance'] = balance
+    return schedule
+
+
+# In[ ]:
+
+
+schedules = amortization_schedules([100000, 45230, 60000], [12, 48, 6], [0.09/12, 0.07/12, 0], [0, 4300, 0])
+schedules['payment'].shape
+
+
+# In[ ]:
+
+
+schedules['payment'][:, :8].round(2)
+
+
+# Let's check that the batch computation gives the same schedules as the generator (apart from tiny differences due to rounding), and that each loan is fully repaid.
+
+# In[ ]:
+
+
+expected = [list(amortization_schedule(100000, 12, 0.09/12)), 
+            list(amortization_schedule(45230, 48, 0.07/12, 4300)), 
+            list(amortization_schedule(60000, 6, 0))]
+all(np.allclose(schedules[key][i, :len(months)], [month[key] for month in months]) 
+    for i, months in enumerate(expected) 
+    for key in ['payment', 'principal', 'interest', 'balance'])
+
+
+# In[ ]:
+
+
+schedules['principal'].sum(axis=1)
+
+
+# For the 100,000 loans in `synthetic-100k.txt`, the padded arrays would have 36 million elements, but the ragged ones only contain the months of each loan.
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-100k.txt')
+start = time.perf_counter()
+schedules = amortization_schedules(synthetic_table['amount'], synthetic_table['duration'], 
+                                   synthetic_table['rate']/12, synthetic_table['down_payment'], ragged=True)
+print('{} months in {:.3f}s'.format(len(schedules['payment']), time.perf_counter() - start))
+
+
+# In[ ]:
+
+
+offsets = schedules['offsets']
+synthetic_table[0], schedules['payment'][offsets[0]:offsets[1]][:3]
+
+
+# The arrays for millions of loans can still be too large for the memory of the computer (a billion months take 8 GB per array). In that case, the loans can be processed in chunks, e.g. by slicing a `LoanStore`.
+
+# ### Projecting the cash flows of a portfolio
+# 
+# To plan ahead, a lender needs to know how much money it will receive every month from all of its loans (its *portfolio*). We could add up the amortization schedules of all the loans, but for millions of loans the schedules contain billions of months. Instead, we can use the fact that each loan pays the same EMI every month, followed by a smaller last payment:
+# 
+# 1. A loan pays its EMI in every month from its first month until (but not including) the month of its last payment. Rather than adding the EMI to each of those months, we add it to the first month and subtract it from the last month of a *changes* array. Adding up the changes with `np.cumsum` then gives the total of the EMIs received in each month.
+# 2. The last payment of each loan is added to the month in which it's paid.
+# 
+# Both steps use `np.bincount`, which adds up the values (`weights`) for each month number in an array. The result only has one number per month, irrespective of the number of loans.
+# 
+# The loans in our CSV files don't have a start date, so the function accepts an optional array `start_month` with the month (counting from 0) of each loan's first payment. Since the EMIs are rounded up, a loan may be repaid in fewer months than its duration, so the number of payments is computed from the formula for the remaining balance: the balance is cleared after `k` payments once `(1+rate)**k >= emi / (emi - loan_amount*rate)`.
+
+# In[ ]:
+
+
+def project_cash_flows(amount, duration, rate, down_payment=0, start_month=0, num_months=None):
+    """Projects the total payments received in each month from a portfolio of loans.
+    
+    Arguments:
+        amount - Array of total amounts to be spent (loan + down payment)
+        duration - Array of durations of the loans (in months)
+        rate - Array of rates of interest (monthly)
+        down_payment (optional) - Array of optional intial payments (deducted from amount)
+        start_month (optional) - Array of the months of the first payments (counting from 0)
+        num_months (optional) - Number of months to project (by default, until all loans are repaid)
+    
+    Returns an array with the total payments received in each month.
+    """
+    loan_amount = np.asarray(amount, dtype=np.float64) - down_payment
+    loan_amount, duration, rate, start_month = np.broadcast_arrays(
+        loan_amount, np.asarray(duration, dtype=np.int64), np.asarray(rate, dtype=np.float64), 
+        np.asarray(start_month, dtype=np.int64))
+    emi = loan_emi_array(loan_amount, duration, rate)
+    
+    # Number of payments until the balance is cleared
+    with np.errstate(divide='ignore', invalid='ignore'):
+        payments = np.where(rate == 0, 
+                            np.ceil(loan_amount / emi), 
+                            np.ceil(np.log(emi / (emi - loan_amount*rate)) / np.log1p(rate)))
+    payments = np.where(np.isfinite(payments), np.clip(payments, 1, duration), duration).astype(np.int64)
+    last_payment = remaining_balance(loan_amount, emi, rate, payments-1) * (1+rate)
+    last_month = start_month + payments - 1
+    
+    if num_months is None:
+        num_months = last_month.max(initial=-1) + 1
+    # Months after the end of the projection are counted in an extra month, which is dropped
+    start_month = np.minimum(start_month, num_months)
+    last_month = np.minimum(last_month, num_months)
+    changes = (np.bincount(start_month, weights=emi, minlength=num_months+1) - 
+               np.bincount(last_month, weights=emi, minlength=num_months+1))
+    cash_flows = np.cumsum(changes) + np.bincount(last_month, weights=last_payment, minlength=num_months+1)
+    return cash_flows[:num_months]
+
+
+# Let's check the projection against the sum of the amortization schedules (computed with `amortization_schedules`) for the loans in `synthetic-100k.txt`, giving each loan a random start month within the next 5 years.
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-100k.txt')
+start_months = np.random.default_rng(42).integers(0, 60, len(synthetic_table))
+loan_args = (synthetic_table['amount'], synthetic_table['duration'], 
+             synthetic_table['rate']/12, synthetic_table['down_payment'])
+
+cash_flows = project_cash_flows(*loan_args, start_month=start_months)
+len(cash_flows), cash_flows[:3]
+
+
+# In[ ]:
+
+
+schedules = amortization_schedules(*loan_args, ragged=True)
+loan_index = np.repeat(np.arange(len(synthetic_table)), synthetic_table['duration'].astype(np.int64))
+expected = np.bincount(start_months[loan_index] + schedules['month'] - 1, weights=schedules['payment'])
+np.allclose(cash_flows, expected)
+
+
+# Now let's project the cash flows of the 1 million loans in `synthetic-0.txt` for the next 10 years. The time is spent computing a few numbers for each loan, and the result is just 120 numbers.
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+start_months = np.random.default_rng(42).integers(0, 60, len(synthetic_table))
+start = time.perf_counter()
+cash_flows = project_cash_flows(synthetic_table['amount'], synthetic_table['duration'], 
+                                synthetic_table['rate']/12, synthetic_table['down_payment'], 
+                                start_month=start_months, num_months=120)
+print('{:.3f}s, {} bytes'.format(time.perf_counter() - start, cash_flows.nbytes))
+cash_flows.reshape(10, 12).sum(axis=1).round()
+
+
+# ### Working backwards from an EMI
+# 
+# Customers often ask the reverse question: *"I can pay 20,000 a month for 5 years, how much can I borrow?"*. Or, given a loan's EMI, we may want to know the rate of interest it implies. Let's write functions which answer these questions for arrays of loans at once.
+# 
+# The loan amount can be computed directly by rearranging the formula used in `loan_emi`:
+# 
+# ```
+# loan_amount = emi * (1 - (1+rate)**-duration) / rate
+# ```
+# 
+# (or `emi * duration` for a 0% rate of interest). Since `loan_emi` rounds the EMI up, we round the amount down to a whole number. Floating point rounding can still put a few amounts just above the limit, so we compute their EMIs with `loan_emi_array` and reduce the amounts which exceed the budget by one.
+
+# In[ ]:
+
+
+def affordable_amount(emi, duration, rate, down_payment=0):
+    """Calculates the largest amounts that can be spent for arrays of EMIs.
+    
+    Arguments:
+        emi - Array of EMIs that can be paid
+        duration - Array of durations of the loans (in months)
+        rate - Array of rates of interest (monthly)
+        down_payment (optional) - Array of optional intial payments (added to the amount)
+    
+    Returns an array of integer amounts for which `loan_emi` is at most `emi`.
+    """
+    emi = np.asarray(emi, dtype=np.float64)
+    duration = np.asarray(duration, dtype=np.float64)
+    rate = np.asarray(rate, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loan_amount = emi * -np.expm1(-duration * np.log1p(rate)) / rate
+        # Loans with a 0% rate of interest
+        loan_amount = np.where(rate == 0, emi * duration, loan_amount)
+    # The down payments are usually float columns, so convert the total amounts to integers
+    amount = np.floor(loan_amount + down_payment).astype(np.int64)
+    # Correct the amounts which are just over the limit due to rounding
+    too_high = loan_emi_array(amount, duration, rate, down_payment) > emi
+    return amount - too_high
+
+
+# In[ ]:
+
+
+affordable_amount([20000, 20000, 8746], [60, 60, 12], [0.09/12, 0, 0.09/12], [0, 0, 50000])
+
+
+# In[ ]:
+
+
+loan_emi(963467, 60, 0.09/12), loan_emi(963468, 60, 0.09/12)
+
+
+# The rate can't be isolated in the formula, so we have to find it numerically. We'll use [Newton's method](https://en.wikipedia.org/wiki/Newton%27s_method): starting from a guess, we repeatedly follow the slope of the EMI (as a function of the rate) to a better guess. Newton's method usually converges in a few steps, but it can overshoot. So, we also keep track of an interval which is known to contain the rate, and whenever a Newton step leaves the interval, we take the midpoint of the interval instead (*bisection*).
+# 
+# The EMI is at least `loan_amount / duration` (for a 0% rate) and less than `loan_amount * rate` plus the repayments, so the rate lies between 0 and `emi / loan_amount`. Every step is performed on the whole array of loans using numpy, and the loans whose rates have converged are left out of the following steps. So, the number of Python-level iterations only depends on how fast the slowest loan converges.
+# 
+# Since the EMIs are rounded up, the implied rates are very slightly higher than the rates that were used to compute them. If the EMI is smaller than `loan_amount / duration`, there's no positive rate of interest, and the result is `nan`.
+
+# In[ ]:
+
+
+def implied_rate(amount, duration, emi, down_payment=0, tolerance=1e-12, max_iterations=100):
+    """Calculates the rates of interest (monthly) implied by arrays of EMIs.
+    
+    Arguments:
+        amount - Array of total amounts spent (loan + down payment)
+        duration - Array of durations of the loans (in months)
+        emi - Array of EMIs
+        down_payment (optional) - Array of optional intial payments (deducted from amount)
+        tolerance (optional) - Maximum error of the rates
+        max_iterations (optional) - Maximum number of steps
+    
+    Returns an array of rates, which are `nan` for EMIs that can't repay the loans.
+    """
+    loan_amount = np.asarray(amount, dtype=np.float64) - down_payment
+    loan_amount, duration, emi = np.broadcast_arrays(loan_amount, np.asarray(duration, dtype=np.float64), 
+                                                     np.asarray(emi, dtype=np.float64))
+    # The rate lies between `low` and `high`, start with the estimate from the total interest paid
+    low = np.zeros(loan_amount.shape)
+    high = emi / loan_amount
+    rate = np.clip(2 * (emi*duration - loan_amount) / (loan_amount * (duration+1)), low, high)
+    # Positions of the loans whose rates haven't converged yet
+    active = np.arange(rate.size)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for iteration in range(max_iterations):
+            r, n, lo, hi = rate.flat[active], duration.flat[active], low.flat[active], high.flat[active]
+            growth_minus_1 = np.expm1(n * np.log1p(r))
+            growth = growth_minus_1 + 1
+            error = loan_amount.flat[active] * r * growth / growth_minus_1 - emi.flat[active]
+            slope = loan_amount.flat[active] * growth * (growth_minus_1 - r*n/(1+r)) / growth_minus_1**2
+            # Narrow down the interval containing the rate
+            hi = np.where(error > 0, r, hi)
+            lo = np.where(error > 0, lo, r)
+            # Take a Newton step, or bisect the interval if the step leaves it
+            new_r = r - error / slope
+            new_r = np.where((new_r > lo) & (new_r < hi), new_r, (lo + hi) / 2)
+            rate.flat[active], low.flat[active], high.flat[active] = new_r, lo, hi
+            active = active[(np.abs(new_r - r) > tolerance) & np.isfinite(new_r)]
+            if len(active) == 0:
+                break
+    # EMIs which repay the loan without any interest, or can't repay it at all
+    rate = np.where(emi * duration == loan_amount, 0, rate)
+    return np.where((emi * duration < loan_amount) | (loan_amount <= 0), np.nan, rate)
+
+
+# In[ ]:
+
+
+implied_rate([100000, 100000, 45230, 100000], [12, 12, 48, 12], [8746, 8334, 981, 8000], [0, 0, 4300, 0]) * 12
+
+
+# Let's solve a million of each kind of query, using the loans in `synthetic-0.txt`: how much could each customer spend with the same EMI, duration and rate, and what rate does each EMI imply?
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+compute_emis(synthetic_table)
+amount, duration = synthetic_table['amount'], synthetic_table['duration']
+rate, down_payment, emi = synthetic_table['rate']/12, synthetic_table['down_payment'], synthetic_table['emi']
+
+start = time.perf_counter()
+amounts = affordable_amount(emi, duration, rate, down_payment)
+print('affordable_amount: {:.3f}s'.format(time.perf_counter() - start))
+# The original amount is always affordable, and one more rupee isn't
+np.all(amounts >= amount), np.all(loan_emi_array(amounts + 1, duration, rate, down_payment) > emi)
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+rates = implied_rate(amount, duration, emi, down_payment)
+print('implied_rate: {:.3f}s'.format(time.perf_counter() - start))
+# The largest difference from the actual rates, in percentage points per year
+np.nanmax(np.abs(rates - rate)) * 12 * 100
+
+
+# ### EMI and interest surfaces
+# 
+# In the functions lesson, we compared `emi_with_interest` and `emi_without_interest` for a single loan, to find the total interest paid. When pricing loan products, it's useful to look at the EMI and the total interest for a whole *surface* of combinations: every amount, rate and duration on a grid, e.g. 1,000 rates by 360 durations for each bucket of amounts.
+# 
+# Using broadcasting, `loan_emi_array` can compute such a grid directly: an array of amounts with the shape `(n, 1)`, an array of rates with the shape `(n, 1)` and an array of durations with the shape `(360,)` give EMIs with the shape `(n, 360)`. The total interest paid on a loan is the total of the EMIs minus the loan amount, `emi * duration - amount`.
+# 
+# A surface for 100 amounts, 1,000 rates and 360 durations has 36 million values, i.e. 288 MB for each of the two arrays, and larger surfaces may not fit in memory at all. So, the function `emi_surface` computes the surface in chunks of (amount, rate) combinations, with at most `chunk_bytes` bytes each. If a `path` is given, each chunk is written to memory-mapped `.npy` files in that directory (like `write_loan_store`), so that the whole surface never needs to be in memory. The arrays of amounts, rates and durations are saved along with the surface.
+
+# In[ ]:
+
+
+def emi_surface(amounts, rates, durations, path=None, chunk_bytes=64*1024*1024):
+    """Computes the EMIs and total interest for every combination of amounts, rates and durations.
+    
+    Arguments:
+        amounts - Array of loan amounts
+        rates - Array of rates of interest (monthly)
+        durations - Array of durations (in months)
+        path (optional) - Directory to write the surface to (instead of keeping it in memory)
+        chunk_bytes (optional) - Approximate size of the chunks of the surface computed at a time
+    
+    Returns a dictionary with the axes ('amounts', 'rates' and 'durations') and the arrays 'emi' and
+    'total_interest', both with the shape (amounts, rates, durations).
+    """
+    surface = {'amounts': np.asarray(amounts, dtype=np.float64), 
+               'rates': np.asarray(rates, dtype=np.float64), 
+               'durations': np.asarray(durations, dtype=np.float64)}
+    shape = (len(surface['amounts']), len(surface['rates']), len(surface['durations']))
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        for key in ['amounts', 'rates', 'durations']:
+            np.save(os.path.join(path, key + '.npy'), surface[key])
+    for key in ['emi', 'total_interest']:
+        if path is None:
+            surface[key] = np.empty(shape, dtype=np.int64)
+        else:
+            surface[key] = np.lib.format.open_memmap(os.path.join(path, key + '.npy'), 
+                                                     mode='w+', dtype=np.int64, shape=shape)
+    
+    # Compute the surface in chunks of (amount, rate) combinations, each a row of durations
+    emi_rows = surface['emi'].reshape(-1, shape[2])
+    interest_rows = surface['total_interest'].reshape(-1, shape[2])
+    rows_per_chunk = max(1, chunk_bytes // (8 * max(shape[2], 1)))
+    durations = surface['durations'][np.newaxis, :]
+    for start in range(0, len(emi_rows), rows_per_chunk):
+        rows = np.arange(start, min(start + rows_per_chunk, len(emi_rows)))
+        amount = surface['amounts'][rows // shape[1], np.newaxis]
+        rate = surface['rates'][rows % shape[1], np.newaxis]
+        emi = loan_emi_array(amount, durations, rate)
+        emi_rows[rows[0]:rows[-1]+1] = emi
+        interest_rows[rows[0]:rows[-1]+1] = emi * durations - amount
+    
+    if path is not None:
+        for key in ['emi', 'total_interest']:
+            surface[key].flush()
+        surface = load_emi_surface(path)
+    return surface
+
+def load_emi_surface(path):
+    """Opens a surface written by `emi_surface`, without reading it into memory."""
+    return {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') 
+            for key in ['amounts', 'rates', 'durations', 'emi', 'total_interest']}
+
+
+# Let's compute the surface for 3 amounts, 1,000 yearly rates between 0% and 20%, and durations from 1 month to 30 years, and look up the loan from the functions lesson: 1 lakh at 9% for 10 years.
+
+# In[ ]:
+
+
+rates = np.linspace(0, 0.2, 1001)[:-1] / 12
+surface = emi_surface([100000, 500000, 1000000], rates, np.arange(1, 361))
+surface['emi'].shape
+
+
+# In[ ]:
+
+
+rate_index = np.argmin(np.abs(surface['rates'] - 0.09/12))
+surface['emi'][0, rate_index, 119], surface['total_interest'][0, rate_index, 119], surface['emi'][0, 0, 119]
+
+
+# The surface can be used to answer questions like "what's the longest duration for which the total interest stays below the loan amount, at each rate?"
+
+# In[ ]:
+
+
+affordable = surface['total_interest'][0] < 100000
+longest_duration = np.where(affordable.all(axis=1), 360, np.argmin(affordable, axis=1))
+longest_duration[::100]
+
+
+# For 20 buckets of amounts, the surface has 7.2 million values, which are written to the directory `./data/emi-surface` in chunks of about 16 MB.
+
+# In[ ]:
+
+
+start = time.perf_counter()
+surface = emi_surface(np.linspace(100000, 2000000, 20), rates, np.arange(1, 361), 
+                      path='./data/emi-surface', chunk_bytes=16*1024*1024)
+print('{:.3f}s'.format(time.perf_counter() - start))
+os.listdir('./data/emi-surface'), surface['emi'].shape
+
+
+# In[ ]:
+
+
+surface = load_emi_surface('./data/emi-surface')
+surface['total_interest'][19, rate_index, [59, 119, 239, 359]]
+
+
+# ### Exact EMIs in paise
+# 
+# `loan_emi` computes the EMI with floating point numbers, which are only accurate to about 16 significant digits, and then rounds it up with `math.ceil`. When the exact EMI is a whole number (or extremely close to one), the tiny rounding error of the floating point computation decides whether it's rounded up or not. For example, a loan of 2,000 at 6% for 1 month should have an EMI of exactly 2,010 (the loan plus 0.5% interest), but `loan_emi` rounds it up to 2,011:
+
+# In[ ]:
+
+
+rate = 0.06/12
+2000 * rate * (1+rate)**1 / ((1+rate)**1 - 1), loan_emi(2000, 1, 0.06/12)
+
+
+# For auditing, we'd like EMIs in whole *paise* (1/100 of a rupee), rounded up from the exact value. Python's `fractions.Fraction` represents a number as an exact ratio of two integers, so the EMI formula can be computed without any rounding, provided that the amounts and rates are exact:
+# 
+# * Amounts are converted to paise, which are whole numbers.
+# * A rate like `0.075` can't be represented exactly as a floating point number, but it's exactly `75000 / 10**6`. So, rates are converted to whole numbers of millionths (or another number of decimal places), and we check that they don't have more decimal places than that.
+# 
+# The function `exact_emi_paise` computes the EMI of one loan exactly.
+
+# In[ ]:
+
+
+import fractions
+
+def exact_emi_paise(loan_paise, duration, rate_units, rate_scale):
+    """Calculates the EMI of a loan exactly, in paise (rounded up).
+    
+    Arguments:
+        loan_paise - Loan amount (excluding the down payment) in paise
+        duration - Duration of the loan (in months)
+        rate_units - Yearly rate of interest, as a multiple of `1 / rate_scale`
+        rate_scale - Denominator of the rate (e.g. 10**6 for millionths)
+    """
+    if rate_units == 0:
+        return -(-loan_paise // duration)
+    rate = fractions.Fraction(rate_units, 12 * rate_scale)
+    growth = (1 + rate) ** duration
+    return math.ceil(loan_paise * rate * growth / (growth - 1))
+
+
+# In[ ]:
+
+
+exact_emi_paise(2000 * 100, 1, 60000, 10**6)
+
+
+# Computing with fractions is far too slow for millions of loans: for a 30-year loan, `growth` has thousands of digits. But we only need it for a few loans. The function `loan_emi_paise` first computes all the EMIs with numpy, and then finds the *ambiguous* ones, whose floating point values are so close to a whole number of paise that the rounding error could change the result. Only those are recomputed exactly with `exact_emi_paise`.
+# 
+# The floating point computation uses `np.expm1(duration * np.log1p(rate))` for `(1+rate)**duration - 1`, as in `remaining_balance`, so that its relative error is less than `1e-14` even for small rates. We treat values within `1e-12` (relative) of a whole number as ambiguous, to be safe. Loans with a 0% rate of interest are computed exactly using integer division.
+
+# In[ ]:
+
+
+def loan_emi_paise(amount, duration, rate, down_payment=0, rate_decimals=6):
+    """Calculates exact EMIs in paise for arrays of loans.
+    
+    Arguments:
+        amount - Array of total amounts to be spent (loan + down payment), in rupees
+        duration - Array of durations of the loans (in months)
+        rate - Array of yearly rates of interest (as in the CSV files)
+        down_payment (optional) - Array of optional intial payments (deducted from amount), in rupees
+        rate_decimals (optional) - Maximum number of decimal places of the rates
+    
+    Returns an array of integers, which are the exact EMIs in paise, rounded up.
+    """
+    loan_paise = (np.round(np.asarray(amount, dtype=np.float64) * 100) - 
+                  np.round(np.asarray(down_payment, dtype=np.float64) * 100)).astype(np.int64)
+    rate = np.asarray(rate, dtype=np.float64)
+    rate_scale = 10**rate_decimals
+    rate_units = np.round(rate * rate_scale).astype(np.int64)
+    if np.any(rate_units / rate_scale != rate):
+        raise ValueError('rates must not have more than {} decimal places'.format(rate_decimals))
+    loan_paise, duration, rate_units = np.broadcast_arrays(loan_paise, np.asarray(duration, dtype=np.int64), 
+                                                           rate_units)
+    if np.any(duration == 0):
+        raise ZeroDivisionError('integer division or modulo by zero')
+    
+    monthly_rate = rate_units / (12 * rate_scale)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth_minus_1 = np.expm1(duration * np.log1p(monthly_rate))
+        emi = loan_paise * monthly_rate * (growth_minus_1+1) / growth_minus_1
+    if np.any(np.abs(emi) >= 2.0**63):
+        raise OverflowError('cannot convert EMIs larger than 2**63 to integers')
+    # Loans with a 0% rate of interest are computed exactly, with integer division
+    zero_rate = rate_units == 0
+    emi_paise = np.where(zero_rate, -(-loan_paise // duration), np.ceil(np.where(zero_rate, 0, emi)).astype(np.int64))
+    
+    # Recompute the EMIs which could be rounded the wrong way
+    ambiguous = ~zero_rate & (np.abs(emi - np.round(emi)) <= 1e-12 * np.abs(emi))
+    for i in np.flatnonzero(ambiguous):
+        emi_paise.flat[i] = exact_emi_paise(int(loan_paise.flat[i]), int(duration.flat[i]), 
+                                            int(rate_units.flat[i]), rate_scale)
+    return emi_paise
+
+
+# In[ ]:
+
+
+loan_emi_paise([2000, 100000, 45230, 100000], [1, 120, 48, 120], [0.06, 0.09, 0.07, 0], [0, 0, 4300, 0])
+
+
+# Let's check the EMIs of 20,000 of our synthetic loans against the exact computation, and compare the time taken for 1 million loans with `loan_emi_array`.
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+amount, duration = synthetic_table['amount'], synthetic_table['duration']
+rate, down_payment = synthetic_table['rate'], synthetic_table['down_payment']
+
+emis = loan_emi_paise(amount[:20000], duration[:20000], rate[:20000], down_payment[:20000])
+expected = [exact_emi_paise(int(round(a*100)) - int(round(d*100)), int(n), int(round(r * 10**6)), 10**6) 
+            for a, n, r, d in zip(amount[:20000].tolist(), duration[:20000].tolist(), 
+                                  rate[:20000].tolist(), down_payment[:20000].tolist())]
+np.array_equal(emis, expected)
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+loan_emi_array(amount, duration, rate/12, down_payment)
+print('loan_emi_array: {:.3f}s'.format(time.perf_counter() - start))
+
+start = time.perf_counter()
+loan_emi_paise(amount, duration, rate, down_payment)
+print('loan_emi_paise: {:.3f}s'.format(time.perf_counter() - start))
+
+
+# ### Statistics in a single pass
+# 
+# After computing the EMIs, we often want some statistics: the number of loans, the total and average EMI, the highest EMI, and so on. Loading all the EMIs into memory to compute them defeats the purpose of processing a file lazily with generators, and looping over the results again doubles the work. Instead, we can update the statistics as each loan passes through, in the same way as `iter_emis` computes the EMIs.
+# 
+# The count, total, minimum and maximum are easy to update one value at a time. For the mean and the variance, we use [Welford's algorithm](https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Welford's_online_algorithm), which updates the mean and the sum of squared differences from the mean (`m2`) with each new value, without the loss of precision of the textbook formula `mean(x**2) - mean(x)**2`. A whole chunk of values (or the statistics of another part of the file) can be combined in the same way using the formula of Chan et al.
+# 
+# Quantiles (like the median, or the EMI which 99% of loans are below) are harder: computing them exactly requires keeping all the values. The class `QuantileSketch` implements a *KLL sketch*, which keeps a small sample of the values and estimates any quantile to within about 1% of the rank (for the default `k=200`):
+# 
+# * New values are added to level 0, where each value stands for 1 original value.
+# * When a level holds too many values, they are sorted and every other value (starting at a random position) is moved to the next level, where each value stands for twice as many original values. The remaining values are discarded.
+# * The levels near the top are allowed to hold more values than the ones at the bottom, so that the heavily weighted values are more accurate.
+# 
+# To estimate a quantile, the values of all the levels are sorted, with their weights, and we find the value at which the total weight reaches the requested fraction. Single values are collected in a list and added to the sketch in batches, since numpy is slow for individual values.
+
+# In[ ]:
+
+
+class QuantileSketch:
+    """A KLL sketch, which estimates quantiles of a stream of values in a small amount of memory."""
+    def __init__(self, k=200, seed=0, buffer_size=10000):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+        self.buffer = []
+        self.buffer_size = buffer_size
+    
+    def capacity(self, level):
+        # The top level holds `k` values, and each level below holds 2/3 as many
+        depth = len(self.levels) - level - 1
+        return max(2, int(math.ceil(self.k * (2/3)**depth)))
+    
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+    
+    def flush(self):
+        if self.buffer:
+            values, self.buffer = self.buffer, []
+            self.update(values)
+    
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(values, dtype=np.float64).ravel()])
+        self.compress()
+    
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                # Keep the largest item if there's an odd number of items
+                items = np.sort(items)
+                odd = len(items) % 2
+                self.levels[level] = items[len(items)-odd:]
+                # Move every other item to the next level, starting at a random position
+                promoted = items[self.rng.integers(2):len(items)-odd:2]
+                self.levels[level+1] = np.concatenate([self.levels[level+1], promoted])
+            level += 1
+    
+    def merge(self, other):
+        """Adds the values of another sketch to this one."""
+        self.flush()
+        other.flush()
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.compress()
+    
+    def quantile(self, q):
+        """Estimates the value(s) below which the fraction(s) `q` of the values lie."""
+        self.flush()
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0**level) for level, items in enumerate(self.levels)])
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan)[()]
+        order = np.argsort(values)
+        cumulative_weights = np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative_weights, np.asarray(q) * cumulative_weights[-1])
+        return values[order][np.minimum(positions, len(values)-1)]
+
+
+# The class `StreamingStats` keeps track of all the statistics. Values can be added one at a time using `add`, or a whole array at a time using `add_array`, and two `StreamingStats` (e.g. for different files, or different parts of a file processed in parallel) can be combined using `merge`. The variance is the *population* variance, like `np.var`.
+
+# In[ ]:
+
+
+class StreamingStats:
+    """Computes the count, sum, mean, variance, minimum, maximum and quantiles of a stream of values."""
+    def __init__(self, k=200):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch(k)
+    
+    def add(self, value):
+        # Welford's algorithm
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sketch.add(value)
+    
+    def add_array(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) > 0:
+            mean = values.mean()
+            self.combine(len(values), values.sum().item(), mean.item(), np.square(values - mean).sum().item(), 
+                         values.min().item(), values.max().item())
+            self.sketch.update(values)
+    
+    def combine(self, count, total, mean, m2, minimum, maximum):
+        # Combine the mean and m2 of two parts (Chan et al.)
+        new_count = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / new_count
+        self.m2 += m2 + delta**2 * self.count * count / new_count
+        self.count = new_count
+        self.total += total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+    
+    def merge(self, other):
+        """Adds the statistics of another `StreamingStats` to this one."""
+        if other.count > 0:
+            self.combine(other.count, other.total, other.mean, other.m2, other.min, other.max)
+            self.sketch.merge(other.sketch)
+    
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count > 0 else math.nan
+    
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+    
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        result = {'count': self.count, 
+                  'sum': self.total, 
+                  'mean': self.mean if self.count > 0 else math.nan, 
+                  'variance': self.variance, 
+                  'std': math.sqrt(self.variance), 
+                  'min': self.min, 
+                  'max': self.max}
+        for q, value in zip(quantiles, np.atleast_1d(self.quantile(quantiles)).tolist()):
+            result['p{:g}'.format(q * 100)] = value
+        return result
+
+
+# The generator `collect_stats` adds a field of each loan to a `StreamingStats` as the loan passes through, so it can be placed anywhere in a chain of generators. Here's the entire process for a file: the loans are read, their EMIs computed, the statistics collected and the results written, all in a single pass and one loan at a time.
+
+# In[ ]:
+
+
+def collect_stats(loans, stats, key='emi'):
+    for loan in loans:
+        stats.add(loan[key])
+        yield loan
+
+
+# In[ ]:
+
+
+emi_stats = StreamingStats()
+write_csv(collect_stats(iter_emis(iter_csv('./data/synthetic-100k.txt')), emi_stats), 
+          './data/synthetic-emis-100k.txt')
+emi_stats.summary()
+
+
+# The same statistics can be collected for a `LoanTable`, a chunk at a time. To read a large file in chunks without loading all of it, let's also define `iter_csv_columnar`, which reads `chunk_size` lines at a time using `itertools.islice` and yields each chunk as a `LoanTable`.
+
+# In[ ]:
+
+
+def iter_csv_columnar(path, chunk_size=100000):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header
+        headers = parse_headers(f.readline())
+        while True:
+            # Parse the next chunk of lines into a flat array of floats
+            values = parse_rows(itertools.islice(f, chunk_size), len(headers))
+            if len(values) == 0:
+                break
+            data = np.frombuffer(values, dtype=np.float64).reshape(-1, len(headers))
+            columns = {}
+            for i, header in enumerate(headers):
+                columns[header] = np.ascontiguousarray(data[:, i])
+            yield LoanTable(columns)
+
+
+# In[ ]:
+
+
+emi_stats = StreamingStats()
+for chunk in iter_csv_columnar('./data/synthetic-0.txt'):
+    compute_emis(chunk)
+    emi_stats.add_array(chunk['emi'])
+emi_stats.summary()
+
+
+# Let's compare with the exact values computed from all the EMIs in memory. The quantiles are only estimates, but the fraction of the EMIs below each estimate is within 1% of the requested one.
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+compute_emis(synthetic_table)
+emis = synthetic_table['emi']
+emis.mean(), emis.var(), np.quantile(emis, [0.5, 0.9, 0.99])
+
+
+# In[ ]:
+
+
+estimates = emi_stats.quantile([0.5, 0.9, 0.99])
+np.searchsorted(np.sort(emis), estimates) / len(emis)
+
+
+# Finally, the statistics of several files can be computed separately (e.g. in parallel) and merged:
+
+# In[ ]:
+
+
+shard_stats = []
+for i in range(2):
+    stats = StreamingStats()
+    for chunk in iter_csv_columnar('./data/synthetic-{}.txt'.format(i)):
+        compute_emis(chunk)
+        stats.add_array(chunk['emi'])
+    shard_stats.append(stats)
+shard_stats[0].merge(shard_stats[1])
+shard_stats[0].summary()
+
+
+# ### Finding the largest loans
+# 
+# Often, we only need the loans with the largest EMIs (or amounts), e.g. the top 1,000 out of 50 million. Sorting all the loans would require loading them into memory. Instead, we can keep just the `k` largest loans seen so far in a *heap*: a list arranged so that the smallest item is always at the front, and can be replaced quickly (in `O(log k)` steps) when a larger loan comes along. The `heapq` module's `nlargest` function does exactly this for any iterable, including generators, so it uses memory proportional to `k`, not to the number of loans.
+
+# In[ ]:
+
+
+import heapq
+import operator
+
+def top_k(loans, k, key='emi'):
+    """Returns the `k` loans with the largest values of `key`, in descending order."""
+    return heapq.nlargest(k, loans, key=operator.itemgetter(key))
+
+
+# In[ ]:
+
+
+top_k(iter_emis(iter_csv('./data/synthetic-100k.txt')), 3)
+
+
+# For chunks of loans in `LoanTable`s, we can do better than looking at each loan in Python. `np.argpartition(values, len(values) - k)` rearranges the positions of the values so that the last `k` positions are those of the `k` largest values (in no particular order), without sorting the entire array. For each chunk, we combine the chunk's `k` largest loans with the `k` largest loans found so far, and keep the `k` largest of those. At the end, we sort just the `k` remaining loans.
+
+# In[ ]:
+
+
+def take_rows(table, rows):
+    """Returns a `LoanTable` containing the given rows (an array of positions) of a table."""
+    return LoanTable({header: column[rows] for header, column in table.columns.items()})
+
+def concat_tables(tables):
+    """Joins `LoanTable`s with the same columns into a single table."""
+    return LoanTable({header: np.concatenate([table[header] for table in tables]) 
+                      for header in tables[0].headers})
+
+def largest_rows(table, k, key):
+    """Returns the (unsorted) positions of the rows with the `k` largest values of `key`."""
+    values = table[key]
+    if k <= 0:
+        return np.arange(0)
+    if len(values) <= k:
+        return np.arange(len(values))
+    return np.argpartition(values, len(values) - k)[len(values) - k:]
+
+def top_k_columnar(chunks, k, key='emi'):
+    """Returns a `LoanTable` with the `k` loans with the largest values of `key`
+    in an iterable of `LoanTable`s, in descending order.
+    
+    The table is empty if `k` is 0, and None is returned if there are no chunks (since the
+    columns aren't known), whereas `top_k` returns an empty list in both cases.
+    """
+    best = None
+    for chunk in chunks:
+        chunk = take_rows(chunk, largest_rows(chunk, k, key))
+        if best is not None:
+            chunk = concat_tables([best, chunk])
+        best = take_rows(chunk, largest_rows(chunk, k, key))
+    if best is None:
+        return None
+    # Sort the remaining rows by descending value
+    return take_rows(best, np.argsort(best[key], kind='stable')[::-1])
+
+
+# Let's find the 1,000 largest loan amounts among the 4 million loans in the 4 synthetic files, reading them a chunk at a time using `iter_csv_columnar` (and `itertools.chain` to combine the chunks of all the files into a single iterable).
+
+# In[ ]:
+
+
+paths = ['./data/synthetic-{}.txt'.format(i) for i in range(4)]
+start = time.perf_counter()
+largest = top_k_columnar(itertools.chain.from_iterable(iter_csv_columnar(path) for path in paths), 1000, key='amount')
+print('{:.3f}s'.format(time.perf_counter() - start))
+largest, largest[0]
+
+
+# We can check the result for a single file by sorting all of its amounts:
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+expected = np.sort(synthetic_table['amount'])[::-1][:1000]
+np.array_equal(top_k_columnar(iter_csv_columnar('./data/synthetic-0.txt'), 1000, key='amount')['amount'], expected)
+
+
+# `top_k_columnar` can also take the largest EMIs, if we compute them for each chunk as it's read. Here's a small generator that does that:
+
+# In[ ]:
+
+
+def iter_emi_chunks(chunks):
+    for chunk in chunks:
+        compute_emis(chunk)
+        yield chunk
+
+top_k_columnar(iter_emi_chunks(iter_csv_columnar('./data/synthetic-0.txt')), 3)[0]
+
+
+# ### Summarizing loans by group
+# 
+# A common question is how the loans are distributed across products: how many loans (and how much money) are there for each duration, or for each range of interest rates? This is called a *group-by* aggregation. With a list of dictionaries, we'd loop over the loans and update a dictionary of totals for each group. For a `LoanTable`, numpy can do the work for an entire chunk at once:
+# 
+# 1. `np.unique(keys, return_inverse=True)` finds the distinct keys in the chunk (the groups), and the group number of each loan. For several keys (e.g. rate and duration), we number the combinations of their values.
+# 2. `np.bincount(groups)` counts the loans in each group, and `np.bincount(groups, weights=values)` adds up their values.
+# 3. After sorting the values by group, `np.minimum.reduceat` and `np.maximum.reduceat` find the smallest and largest value in each group's part of the array.
+# 
+# The results for each chunk are then merged into a dictionary with one entry per group (a *hash aggregation*), so the file can be processed one chunk at a time, while only the totals for each group are kept in memory.
+# 
+# Continuous values like the rate can be grouped into *bins*: with a bin width of 0.01, the rates from 0.07 up to (but not including) 0.08 are grouped under 0.07.
+
+# In[ ]:
+
+
+class GroupBy:
+    """Computes the count, and the sum, mean, minimum and maximum of some columns for groups of loans."""
+    def __init__(self, keys, values=('amount', 'emi'), bins=None):
+        self.keys = list(keys)
+        self.values = list(values)
+        self.bins = dict(bins or {})
+        self.groups = {}
+    
+    def key_columns(self, table):
+        columns = []
+        for key in self.keys:
+            column = table[key]
+            # Replace each value with the start of its bin (rounding off tiny errors like 0.06/0.01 = 5.999...)
+            if key in self.bins:
+                width = self.bins[key]
+                column = np.round(np.floor(np.round(column / width, 9)) * width, 10)
+            columns.append(column)
+        return columns
+    
+    def update(self, table):
+        """Adds the loans in a `LoanTable` to the groups."""
+        if len(table) == 0:
+            return
+        # Number the combinations of keys in the table
+        codes = np.zeros(len(table), dtype=np.int64)
+        uniques = []
+        for column in self.key_columns(table):
+            unique, inverse = np.unique(column, return_inverse=True)
+            codes = codes * len(unique) + inverse.ravel()
+            uniques.append(unique)
+        group_codes, groups = np.unique(codes, return_inverse=True)
+        groups = groups.ravel()
+        
+        # Compute the aggregates for each group
+        counts = np.bincount(groups)
+        order = np.argsort(groups, kind='stable')
+        starts = np.cumsum(counts) - counts
+        aggregates = {'count': counts.tolist()}
+        for name in self.values:
+            column = table[name]
+            aggregates[name + '_sum'] = np.bincount(groups, weights=column, minlength=len(counts)).tolist()
+            aggregates[name + '_min'] = np.minimum.reduceat(column[order], starts).tolist()
+            aggregates[name + '_max'] = np.maximum.reduceat(column[order], starts).tolist()
+        
+        # Find the keys of each group from its number
+        key_values = []
+        for unique in reversed(uniques):
+            key_values.insert(0, unique[group_codes % len(unique)].tolist())
+            group_codes = group_codes // len(unique)
+        
+        # Merge the aggregates into those of the groups seen so far
+        for i, key in enumerate(zip(*key_values)):
+            group = self.groups.get(key)
+            if group is None:
+                self.groups[key] = {name: values[i] for name, values in aggregates.items()}
+                continue
+            for name, values in aggregates.items():
+                if name.endswith('_min'):
+                    group[name] = min(group[name], values[i])
+                elif name.endswith('_max'):
+                    group[name] = max(group[name], values[i])
+                else:
+                    group[name] += values[i]
+    
+    def result(self):
+        """Returns a `LoanTable` with one row per group, sorted by the keys."""
+        keys = sorted(self.groups)
+        columns = {}
+        for i, header in enumerate(self.keys):
+            columns[header] = np.array([key[i] for key in keys])
+        columns['count'] = np.array([self.groups[key]['count'] for key in keys], dtype=np.int64)
+        for name in self.values:
+            for aggregate in ['sum', 'mean', 'min', 'max']:
+                if aggregate == 'mean':
+                    values = [self.groups[key][name + '_sum'] / self.groups[key]['count'] for key in keys]
+                else:
+                    values = [self.groups[key][name + '_' + aggregate] for key in keys]
+                columns[name + '_' + aggregate] = np.array(values, dtype=np.float64)
+        return LoanTable(columns)
+
+def group_by(loans, keys, values=('amount', 'emi'), bins=None):
+    """Aggregates a `LoanTable`, or an iterable of `LoanTable` chunks, by groups of keys."""
+    if isinstance(loans, LoanTable):
+        loans = [loans]
+    aggregator = GroupBy(keys, values, bins)
+    for chunk in loans:
+        aggregator.update(chunk)
+    return aggregator.result()
+
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-100k.txt')
+compute_emis(synthetic_table)
+by_duration = group_by(synthetic_table, ['duration'])
+by_duration
+
+
+# In[ ]:
+
+
+by_duration[0], by_duration[len(by_duration)-1]
+
+
+# Let's check the counts and sums against a simple loop over the loans, using a dictionary.
+
+# In[ ]:
+
+
+totals = {}
+for loan in synthetic_table:
+    group = totals.setdefault(loan['duration'], [0, 0])
+    group[0] += 1
+    group[1] += loan['emi']
+(by_duration['count'].tolist() == [totals[d][0] for d in sorted(totals)], 
+ np.allclose(by_duration['emi_sum'], [totals[d][1] for d in sorted(totals)]))
+
+
+# Now let's group all 4 million loans in the synthetic files by rate (in bins of 1%) and duration, a chunk at a time, and save the summary to a CSV file.
+
+# In[ ]:
+
+
+paths = ['./data/synthetic-{}.txt'.format(i) for i in range(4)]
+start = time.perf_counter()
+chunks = iter_emi_chunks(itertools.chain.from_iterable(iter_csv_columnar(path) for path in paths))
+summary = group_by(chunks, ['rate', 'duration'], bins={'rate': 0.01})
+print('{:.3f}s'.format(time.perf_counter() - start))
+write_csv(summary, './data/synthetic-summary.txt')
+summary, summary['count'].sum()
+
+
+# In[ ]:
+
+
+summary[0]
+
+
+# ### Reading only the columns and rows we need
+# 
+# Suppose we only need the amounts of the loans with a duration of at least 20 years. `read_csv` converts every field of every line to a float and creates a dictionary for every loan, only for most of them to be thrown away. It's much cheaper to:
+# 
+# 1. Check the conditions first, converting only the fields they refer to, and skip a line as soon as a condition fails.
+# 2. For the remaining lines, convert only the fields of the requested columns.
+# 
+# This is called *projection* (selecting columns) and *predicate pushdown* (filtering rows as early as possible). The conditions are given as a list of tuples `(column, operator, value)`, e.g. `[('duration', '>=', 240)]`, and a loan must satisfy all of them. The `operator` module provides the comparison operators as functions, e.g. `operator.ge(a, b)` is `a >= b`.
+
+# In[ ]:
+
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '==': operator.eq, 
+             '!=': operator.ne, '>=': operator.ge, '>': operator.gt}
+
+def parse_conditions(where, headers):
+    """Converts a list of (column, operator, value) tuples into (position, function, value) tuples."""
+    conditions = []
+    for column, op, value in where or []:
+        if column not in headers:
+            raise KeyError(column)
+        if op not in OPERATORS:
+            raise ValueError('unknown operator {!r}, expected one of {}'.format(op, list(OPERATORS)))
+        conditions.append((headers.index(column), OPERATORS[op], value))
+    return conditions
+
+def parse_field(items, position):
+    # Missing and empty fields are treated as 0
+    if position >= len(items) or items[position] == '':
+        return 0.0
+    return float(items[position])
+
+def row_matches(items, conditions):
+    for position, compare, value in conditions:
+        if not compare(parse_field(items, position), value):
+            return False
+    return True
+
+
+# `iter_csv` and `read_csv` now accept the arguments `columns` (a list of column names) and `where` (a list of conditions). Without them, they work exactly as before. When reading from the cache, the whole table is already in memory as arrays, so the conditions are applied to entire columns with numpy instead, by the function `filter_table`.
+
+# In[ ]:
+
+
+def iter_csv(path, columns=None, where=None):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header from the first line
+        headers = parse_headers(f.readline())
+        # Read and parse all the fields, if no columns or conditions are specified
+        if columns is None and where is None:
+            for data_line in f:
+                values = parse_values(data_line)
+                yield create_item_dict(values, headers)
+            return
+        
+        if columns is None:
+            columns = headers
+        positions = [headers.index(column) for column in columns]
+        conditions = parse_conditions(where, headers)
+        for data_line in f:
+            items = data_line.strip().split(',')
+            # Skip the line unless it satisfies all the conditions
+            if not row_matches(items, conditions):
+                continue
+            # Parse only the requested columns
+            yield {column: parse_field(items, position) for column, position in zip(columns, positions)}
+
+def filter_table(table, columns=None, where=None):
+    """Returns a `LoanTable` with the rows of `table` which satisfy the conditions `where`,
+    and only the given columns."""
+    mask = np.ones(len(table), dtype=bool)
+    for column, op, value in where or []:
+        if op not in OPERATORS:
+            raise ValueError('unknown operator {!r}, expected one of {}'.format(op, list(OPERATORS)))
+        mask &= OPERATORS[op](table[column], value)
+    if columns is None:
+        columns = table.headers
+    return LoanTable({column: table[column][mask] for column in columns})
+
+def read_csv(path, cache=False, columns=None, where=None):
+    if cache:
+        table = read_csv_columnar(path, cache=True)
+        if columns is not None or where is not None:
+            table = filter_table(table, columns, where)
+        return list(table)
+    return list(iter_csv(path, columns, where))
+
+
+# In[ ]:
+
+
+read_csv('./data/loans2.txt', columns=['amount', 'rate'], where=[('duration', '>=', 36), ('rate', '<', 0.1)])
+
+
+# In[ ]:
+
+
+read_csv('./data/loans2.txt', cache=True, columns=['amount', 'rate'], where=[('duration', '>=', 36), ('rate', '<', 0.1)])
+
+
+# Let's compare the time taken to read the amounts of the loans with a duration of at least 240 months from `synthetic-100k.txt`, with and without pushdown.
+
+# In[ ]:
+
+
+start = time.perf_counter()
+expected = [{'amount': loan['amount']} for loan in read_csv('./data/synthetic-100k.txt') if loan['duration'] >= 240]
+print('read_csv, then filter: {:.3f}s'.format(time.perf_counter() - start))
+
+start = time.perf_counter()
+loans = read_csv('./data/synthetic-100k.txt', columns=['amount'], where=[('duration', '>=', 240)])
+print('read_csv with pushdown: {:.3f}s'.format(time.perf_counter() - start))
+len(loans), loans == expected
+
+
+# The same approach works for reading a file in chunks of arrays. `parse_rows_where` parses only the requested columns of the lines that satisfy the conditions, and `iter_csv_columnar` passes the `columns` and `where` arguments on to it.
+
+# In[ ]:
+
+
+def parse_rows_where(lines, positions, conditions):
+    result = array.array('d')
+    for data_line in lines:
+        items = data_line.strip().split(',')
+        if row_matches(items, conditions):
+            result.extend([parse_field(items, position) for position in positions])
+    return result
+
+def iter_csv_columnar(path, chunk_size=100000, columns=None, where=None):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header
+        headers = parse_headers(f.readline())
+        if columns is None:
+            columns = headers
+        positions = [headers.index(column) for column in columns]
+        conditions = parse_conditions(where, headers)
+        while True:
+            # Parse the matching rows of the next chunk of lines into a flat array of floats
+            lines = list(itertools.islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            if columns == headers and not conditions:
+                values = parse_rows(lines, len(headers))
+            else:
+                values = parse_rows_where(lines, positions, conditions)
+            data = np.frombuffer(values, dtype=np.float64).reshape(-1, len(columns))
+            table = {}
+            for i, column in enumerate(columns):
+                table[column] = np.ascontiguousarray(data[:, i])
+            yield LoanTable(table)
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+chunks = iter_csv_columnar('./data/synthetic-0.txt', columns=['amount'], where=[('duration', '>=', 240)])
+amounts = np.concatenate([chunk['amount'] for chunk in chunks])
+print('{:.3f}s'.format(time.perf_counter() - start))
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+np.array_equal(amounts, synthetic_table['amount'][synthetic_table['duration'] >= 240])
+
+
+# ### Sorted indexes for range queries
+# 
+# Even with predicate pushdown, finding the loans with an amount between 10 and 20 lakhs requires reading the entire file. If the same kind of query is run again and again, it's worth building an *index* once: the values of the column in sorted order, along with the position of each loan in the file. To find the loans in a range of values, we can then:
+# 
+# 1. Use *binary search* (`np.searchsorted`) to find where the range starts and ends in the sorted values. This only looks at about 20 values, even for a million loans.
+# 2. Read just the matching loans from the file. To read them sequentially (which is faster than jumping back and forth), the positions are sorted first, so the loans are returned in the order in which they appear in the file.
+# 
+# For a CSV file, the positions are the *byte offsets* of the lines, which can be passed to the file's `seek` method to jump straight to a line. For a `LoanStore`, the positions are row numbers. The index is saved in a directory next to the file (or inside the store), with the values and positions in separate `.npy` files which are memory-mapped, so a query only reads the parts of the index it needs. Like the cache we created earlier, the index records the size and modification time of the source, and it's rebuilt if they have changed.
+
+# In[ ]:
+
+
+def index_dir(path, column):
+    if os.path.isdir(path):
+        return os.path.join(path, 'index-' + column)
+    return '{}.index-{}'.format(path, column)
+
+def source_stat(path):
+    # A LoanStore is complete (and modified) once its headers are written
+    if os.path.isdir(path):
+        path = os.path.join(path, 'headers.json')
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def build_index(path, column):
+    """Builds a sorted index of a column for a CSV file or a `LoanStore` directory."""
+    stat = source_stat(path)
+    if os.path.isdir(path):
+        values = np.array(LoanStore(path)[column])
+        positions = np.arange(len(values))
+    else:
+        # Record the byte offset of each line, and its value in the column
+        values, positions = array.array('d'), array.array('q')
+        with open(path, 'rb') as f:
+            header_line = f.readline()
+            position = parse_headers(header_line.decode()).index(column)
+            offset = len(header_line)
+            for line in f:
+                values.append(parse_field(line.decode().strip().split(','), position))
+                positions.append(offset)
+                offset += len(line)
+        values, positions = np.frombuffer(values, dtype=np.float64), np.frombuffer(positions, dtype=np.int64)
+    order = np.argsort(values, kind='stable')
+    
+    directory = index_dir(path, column)
+    os.makedirs(directory, exist_ok=True)
+    # Remove the description first, so that an incomplete index is never used
+    if os.path.exists(os.path.join(directory, 'index.json')):
+        os.remove(os.path.join(directory, 'index.json'))
+    np.save(os.path.join(directory, 'values.npy'), values[order])
+    np.save(os.path.join(directory, 'positions.npy'), positions[order])
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(dict(stat, column=column), f)
+
+def load_index(path, column):
+    """Returns the sorted values and positions of an up-to-date index, or None."""
+    directory = index_dir(path, column)
+    try:
+        with open(os.path.join(directory, 'index.json'), 'r') as f:
+            description = json.load(f)
+        if description != dict(source_stat(path), column=column):
+            return None
+        return (np.load(os.path.join(directory, 'values.npy'), mmap_mode='r'), 
+                np.load(os.path.join(directory, 'positions.npy'), mmap_mode='r'))
+    except (OSError, ValueError):
+        return None
+
+
+# The function `range_query` returns the loans whose values in a column lie between `low` and `high` (inclusive), building the index first if necessary. For a CSV file, it returns a list of dictionaries (like `read_csv`), and for a `LoanStore`, a `LoanTable`.
+
+# In[ ]:
+
+
+def range_query(path, column, low, high):
+    """Returns the loans with `low <= loan[column] <= high` in a CSV file or a `LoanStore`."""
+    index = load_index(path, column)
+    if index is None:
+        build_index(path, column)
+        index = load_index(path, column)
+    values, positions = index
+    # Find the range using binary search, then sort the positions to read the loans in order
+    start = np.searchsorted(values, low, side='left')
+    end = np.searchsorted(values, high, side='right')
+    positions = np.sort(positions[start:end])
+    
+    if os.path.isdir(path):
+        return take_rows(LoanStore(path), positions)
+    loans = []
+    with open(path, 'rb') as f:
+        headers = parse_headers(f.readline().decode())
+        for offset in positions.tolist():
+            f.seek(offset)
+            loans.append(create_item_dict(parse_values(f.readline().decode()), headers))
+    return loans
+
+
+# Let's build an index of the amounts in `synthetic-0.txt`, which has a million loans, and find the loans between 10 and 10.1 lakhs.
+
+# In[ ]:
+
+
+start = time.perf_counter()
+build_index('./data/synthetic-0.txt', 'amount')
+print('build_index: {:.3f}s'.format(time.perf_counter() - start))
+os.listdir('./data/synthetic-0.txt.index-amount')
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+loans = range_query('./data/synthetic-0.txt', 'amount', 1000000, 1010000)
+print('range_query: {:.3f}s'.format(time.perf_counter() - start))
+
+start = time.perf_counter()
+expected = read_csv('./data/synthetic-0.txt', where=[('amount', '>=', 1000000), ('amount', '<=', 1010000)])
+print('read_csv with pushdown: {:.3f}s'.format(time.perf_counter() - start))
+len(loans), loans == expected
+
+
+# For a `LoanStore`, the matching rows are read straight from the memory-mapped columns:
+
+# In[ ]:
+
+
+write_loan_store(read_csv_columnar('./data/synthetic-0.txt'), './data/synthetic-0-store')
+start = time.perf_counter()
+table = range_query('./data/synthetic-0-store', 'amount', 1000000, 2000000)
+print('range_query: {:.3f}s'.format(time.perf_counter() - start))
+table, table['amount'].min(), table['amount'].max()
+
+
+# ### Querying loans with SQLite
+# 
+# For ad-hoc questions, it's convenient to load the loans into a database and use SQL. Python includes the `sqlite3` module, which stores an entire database in a single file, without any server. Loading millions of rows into SQLite is fast, provided that we:
+# 
+# * insert many rows with a single call to `executemany`, rather than calling `execute` for each row
+# * insert a large batch of rows in each *transaction*: by default, SQLite makes sure every transaction is safely written to the disk, which takes a while
+# * use `PRAGMA` statements to relax some safety settings for the duration of the load: `synchronous = OFF` (don't wait for the disk), `journal_mode = OFF` (don't keep a journal for rolling back changes), and a larger `cache_size` (in KB, when negative) for sorting and building indexes in memory
+# * create the indexes after all the rows have been inserted, rather than updating them row by row
+# 
+# Without the safety settings, a crash during the load could leave a broken database. So, like `save_cached_table`, `write_sqlite` creates the database in a temporary file, and only replaces the existing database once the load is complete.
+
+# In[ ]:
+
+
+import sqlite3
+
+def write_sqlite(loans, path, table='loans', index_columns=('duration', 'rate', 'amount'), batch_size=100000):
+    """Loads loans into a table of a new SQLite database.
+    
+    Arguments:
+        loans - A `LoanTable`, or an iterable of dictionaries (e.g. a list or a generator)
+        path - Path of the database file (replaced if it exists)
+        table (optional) - Name of the table
+        index_columns (optional) - Columns to create indexes for
+        batch_size (optional) - Number of rows inserted per transaction
+    
+    Returns the number of rows loaded.
+    """
+    # Get the headers, and the type of each column
+    if isinstance(loans, LoanTable):
+        headers = loans.headers
+        types = ['INTEGER' if loans[header].dtype.kind in 'iu' else 'REAL' for header in headers]
+        # Convert a chunk of each column to Python numbers at a time
+        batches = (list(zip(*[loans[header][start:start+batch_size].tolist() for header in headers])) 
+                   for start in range(0, len(loans), batch_size))
+    else:
+        loans = iter(loans)
+        first_loan = next(loans, None)
+        if first_loan is None:
+            return 0
+        headers = list(first_loan.keys())
+        types = ['INTEGER' if isinstance(first_loan[header], int) else 'REAL' for header in headers]
+        # Build the tuples explicitly (`itemgetter` returns a single value instead of a tuple for one column)
+        rows = (tuple(loan[header] for header in headers) for loan in itertools.chain([first_loan], loans))
+        batches = iter(lambda: list(itertools.islice(rows, batch_size)), [])
+    
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA cache_size = -262144')
+            connection.execute('PRAGMA temp_store = MEMORY')
+            columns = ', '.join('"{}" {}'.format(header, type) for header, type in zip(headers, types))
+            connection.execute('CREATE TABLE "{}" ({})'.format(table, columns))
+            insert = 'INSERT INTO "{}" VALUES ({})'.format(table, ', '.join(['?'] * len(headers)))
+            num_rows = 0
+            for batch in batches:
+                # Each batch is inserted in a single transaction
+                with connection:
+                    connection.executemany(insert, batch)
+                num_rows += len(batch)
+            for column in index_columns:
+                if column in headers:
+                    connection.execute('CREATE INDEX "{0}_{1}" ON "{0}" ("{1}")'.format(table, column))
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return num_rows
+
+
+# To use the results of a query in our pipeline, `iter_sqlite` runs a query and yields the rows as dictionaries (like `iter_csv`). It fetches `batch_size` rows at a time with `fetchmany`, so the results of a large query are never all in memory at once. Queries should pass values as `parameters` (with `?` placeholders in the query), instead of inserting them into the query string.
+
+# In[ ]:
+
+
+def iter_sqlite(path, query='SELECT * FROM loans', parameters=(), batch_size=10000):
+    connection = sqlite3.connect(path)
+    try:
+        cursor = connection.execute(query, parameters)
+        headers = [description[0] for description in cursor.description]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(headers, row))
+    finally:
+        connection.close()
+
+
+# Let's load the million loans in `synthetic-0.txt`, with their EMIs, into a database, with and without the indexes. Building each index requires sorting the whole table, so it takes about as long as inserting the rows.
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+compute_emis(synthetic_table)
+start = time.perf_counter()
+num_rows = write_sqlite(synthetic_table, './data/synthetic-0.db', index_columns=())
+seconds = time.perf_counter() - start
+print('without indexes: {} rows in {:.3f}s ({:,.0f} rows/s)'.format(num_rows, seconds, num_rows / seconds))
+
+start = time.perf_counter()
+num_rows = write_sqlite(synthetic_table, './data/synthetic-0.db')
+seconds = time.perf_counter() - start
+print('with indexes: {} rows in {:.3f}s ({:,.0f} rows/s)'.format(num_rows, seconds, num_rows / seconds))
+
+
+# Queries on the indexed columns don't need to scan the entire table. SQLite's `EXPLAIN QUERY PLAN` shows how it will run a query:
+
+# In[ ]:
+
+
+query = 'SELECT * FROM loans WHERE amount BETWEEN ? AND ? ORDER BY amount DESC'
+list(iter_sqlite('./data/synthetic-0.db', 'EXPLAIN QUERY PLAN ' + query, (1000000, 1010000)))
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+loans = list(iter_sqlite('./data/synthetic-0.db', query, (1000000, 1010000)))
+print('{:.3f}s'.format(time.perf_counter() - start))
+len(loans), loans[0]
+
+
+# SQL can also do aggregations, and the results can be streamed back into our functions, e.g. to write them to a CSV file:
+
+# In[ ]:
+
+
+query = '''SELECT duration, COUNT(*) AS count, SUM(amount) AS amount_sum, MAX(emi) AS emi_max 
+           FROM loans WHERE rate >= ? GROUP BY duration ORDER BY duration'''
+write_csv(iter_sqlite('./data/synthetic-0.db', query, (0.1,)), './data/synthetic-0-by-duration.txt')
+read_csv('./data/synthetic-0-by-duration.txt')[:3]
+
+
+# The loans can also be loaded from a generator, e.g. straight from a CSV file, without keeping them all in memory:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+num_rows = write_sqlite(iter_emis(iter_csv('./data/synthetic-100k.txt')), './data/synthetic-100k.db')
+print('{} rows in {:.3f}s'.format(num_rows, time.perf_counter() - start))
+next(iter_sqlite('./data/synthetic-100k.db'))
+
+
+# ### Skipping blocks of loans with zone maps
+# 
+# Indexes help with queries on one column, but need to be built (and stored) for every column we want to query. A lighter approach, used by columnar file formats like Parquet, is to split the loans into *blocks* of, say, 100,000 rows, and to store the minimum and maximum value of every column for each block. These statistics are called a *zone map*. To find the loans with `rate > 0.12`, we can skip every block whose maximum rate is at most 0.12, without reading it at all.
+# 
+# Let's define a simple file format which stores the loans block by block:
+# 
+# * The file starts with the 8 bytes `LOANBLK1`, which identify the format.
+# * Each block contains the values of each column, one column after the other, in binary form (like the `.npy` files of a `LoanStore`), so a column of a block can be read without reading the other columns.
+# * The *footer* at the end of the file describes the file in JSON: the headers and data types of the columns, and for each block, the number of rows, the position (byte offset) of each column, and the minimum and maximum value of each column.
+# * The last 16 bytes of the file contain the length of the footer (as an 8 byte integer), followed by the bytes `LOANBLK1` again. To read the footer, we first read these 16 bytes using `seek` with a negative offset, relative to the end of the file.
+# 
+# The footer can only be written once all the blocks are written, so we can write a file from a generator of chunks without keeping all the loans in memory. As with the cache, the file is written to a temporary file first and then renamed.
+
+# In[ ]:
+
+
+BLOCKED_FILE_MAGIC = b'LOANBLK1'
+
+def write_blocked_file(loans, path, block_size=100000):
+    """Writes loans to a file in blocks, along with the minimum and maximum of each column in each block.
+    
+    Arguments:
+        loans - A `LoanTable` (split into blocks of `block_size` rows), or an iterable of `LoanTable` blocks
+        path - Path of the file to be written
+        block_size (optional) - Number of rows per block, when `loans` is a `LoanTable`
+    """
+    if isinstance(loans, LoanTable):
+        table = loans
+        loans = (take_rows(table, np.arange(start, min(start + block_size, len(table)))) 
+                 for start in range(0, len(table), block_size))
+    footer = {'headers': None, 'dtypes': None, 'blocks': []}
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(BLOCKED_FILE_MAGIC)
+            for block in loans:
+                if len(block) == 0:
+                    continue
+                if footer['headers'] is None:
+                    footer['headers'] = block.headers
+                    footer['dtypes'] = [block[header].dtype.str for header in block.headers]
+                # Write each column of the block, and record its position and zone map
+                offsets, minimums, maximums = [], [], []
+                for header, dtype in zip(footer['headers'], footer['dtypes']):
+                    column = np.ascontiguousarray(block[header], dtype=dtype)
+                    offsets.append(f.tell())
+                    f.write(column.tobytes())
+                    minimums.append(column.min().item())
+                    maximums.append(column.max().item())
+                footer['blocks'].append({'rows': len(block), 'offsets': offsets, 'min': minimums, 'max': maximums})
+            footer_bytes = json.dumps(footer).encode()
+            f.write(footer_bytes)
+            f.write(len(footer_bytes).to_bytes(8, 'little') + BLOCKED_FILE_MAGIC)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def read_blocked_footer(f):
+    f.seek(-16, os.SEEK_END)
+    tail = f.read(16)
+    if tail[8:] != BLOCKED_FILE_MAGIC:
+        raise ValueError('not a blocked loans file')
+    footer_length = int.from_bytes(tail[:8], 'little')
+    f.seek(-16 - footer_length, os.SEEK_END)
+    return json.loads(f.read(footer_length))
+
+
+# To scan a file, `scan_blocked_file` first checks the zone map of each block against the conditions (given as `(column, operator, value)` tuples, as for `read_csv`). The function `block_may_match` answers the question "could any value between `minimum` and `maximum` satisfy the condition?". For example, `rate > 0.12` can only be satisfied if the maximum rate is greater than 0.12.
+# 
+# For the blocks that may match, only the columns needed for the conditions and the result are read, using `seek` and `np.fromfile`. The blocks can still contain loans which don't satisfy the conditions, so the rows are then filtered using `filter_table`. The optional dictionary `stats` counts the blocks and bytes read, to see how much work was saved.
+
+# In[ ]:
+
+
+def block_may_match(minimum, maximum, op, value):
+    if op == '<':
+        return minimum < value
+    if op == '<=':
+        return minimum <= value
+    if op == '>':
+        return maximum > value
+    if op == '>=':
+        return maximum >= value
+    if op == '==':
+        return minimum <= value <= maximum
+    if op == '!=':
+        return not (minimum == maximum == value)
+    raise ValueError('unknown operator {!r}, expected one of {}'.format(op, list(OPERATORS)))
+
+def scan_blocked_file(path, columns=None, where=None, stats=None):
+    """Yields a `LoanTable` with the matching loans of each block of a blocked file that may match."""
+    if stats is None:
+        stats = {}
+    for key in ['blocks', 'blocks_read', 'bytes_read']:
+        stats.setdefault(key, 0)
+    with open(path, 'rb') as f:
+        footer = read_blocked_footer(f)
+        headers = footer['headers'] or []
+        if columns is None:
+            columns = headers
+        where = list(where or [])
+        needed = list(columns) + [column for column, op, value in where if column not in columns]
+        for column in needed:
+            if column not in headers:
+                raise KeyError(column)
+        
+        for block in footer['blocks']:
+            stats['blocks'] += 1
+            # Skip the block if its zone map rules out any of the conditions
+            if not all(block_may_match(block['min'][headers.index(column)], block['max'][headers.index(column)], 
+                                       op, value) 
+                       for column, op, value in where):
+                continue
+            stats['blocks_read'] += 1
+            # Read only the needed columns of the block
+            table = {}
+            for column in needed:
+                i = headers.index(column)
+                f.seek(block['offsets'][i])
+                table[column] = np.fromfile(f, dtype=footer['dtypes'][i], count=block['rows'])
+                stats['bytes_read'] += table[column].nbytes
+            yield filter_table(LoanTable(table), columns, where)
+
+def read_blocked_file(path, columns=None, where=None, stats=None):
+    """Reads the matching loans of a blocked file into a single `LoanTable`."""
+    tables = list(scan_blocked_file(path, columns, where, stats))
+    if not tables:
+        with open(path, 'rb') as f:
+            headers = read_blocked_footer(f)['headers'] or []
+        return LoanTable({column: np.empty(0) for column in (columns or headers)})
+    return concat_tables(tables)
+
+
+# Zone maps only help if similar values are stored close together. The loans in our synthetic files are in random order, so every block contains both low and high rates. Data is often naturally ordered (e.g. by the date the loan was made), but here we'll sort the loans by rate before writing them, which we can do for a file that's queried often.
+
+# In[ ]:
+
+
+synthetic_table = read_csv_columnar('./data/synthetic-0.txt')
+compute_emis(synthetic_table)
+write_blocked_file(take_rows(synthetic_table, np.argsort(synthetic_table['rate'], kind='stable')), 
+                   './data/synthetic-0.blocks', block_size=50000)
+os.path.getsize('./data/synthetic-0.blocks')
+
+
+# In[ ]:
+
+
+stats = {}
+start = time.perf_counter()
+high_rates = read_blocked_file('./data/synthetic-0.blocks', columns=['amount', 'rate', 'emi'], 
+                               where=[('rate', '>', 0.12)], stats=stats)
+print('{:.3f}s'.format(time.perf_counter() - start))
+high_rates, stats
+
+
+# In[ ]:
+
+
+np.array_equal(np.sort(high_rates['amount']), np.sort(synthetic_table['amount'][synthetic_table['rate'] > 0.12]))
+
+
+# Only the blocks containing rates above 12% were read, and only 3 of the 5 columns (including the EMIs, which were stored along with the loans). On the other hand, the amounts are spread over all the blocks, so a query on the amount has to read every block:
+
+# In[ ]:
+
+
+stats = {}
+read_blocked_file('./data/synthetic-0.blocks', where=[('amount', '>=', 1000000), ('amount', '<=', 1010000)], stats=stats)
+stats
+
+
+# A blocked file can also be written from a large CSV file a chunk at a time, using `iter_csv_columnar`. Since the loans in this file aren't sorted, a query on the duration has to read every block, but still only reads 2 of the 4 columns.
+
+# In[ ]:
+
+
+write_blocked_file(iter_csv_columnar('./data/synthetic-1.txt', 100000), './data/synthetic-1.blocks')
+stats = {}
+read_blocked_file('./data/synthetic-1.blocks', columns=['amount'], where=[('duration', '==', 360)], stats=stats), stats
+
+
 # ## Save and upload your notebook
 # 
 # Whether you're running this Jupyter notebook on an online service like Binder or on your local machine, it's important to save your work from time, so that you can access it later, or share it online. You can upload this notebook to your [Jovian.ml](https://jovian.ml) account using the `jovian` Python library.